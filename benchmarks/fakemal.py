@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Copyright Penta (c) 2018/2020 - Under BSD License
+
+# Compatible for Python 3.7.X
+#
+# Stand-in for MyAnimeList, used by the load tests of the bot (benchmarks/loadtest.py).
+# It serves synthetic feeds (rss.php), media pages, thumbnails and profiles in the format
+# of MyAnimeList, the users updating their lists at the given rate. It can also be started
+# alone, to test a bot running on another machine:
+# python3 benchmarks/fakemal.py --port 8181 --users 1000 --updates-per-hour 2
+
+# Library import
+import argparse
+import asyncio
+import email.utils
+import random
+import time
+
+from datetime import datetime, timedelta, timezone
+from aiohttp import web
+
+# Number of items in a feed, like on MyAnimeList
+FEED_SIZE = 15
+
+# Timezone of the dates of the feeds of MyAnimeList
+MAL_TIMEZONE = timezone(timedelta(hours=-7))
+
+# Statuses of the items, by media
+STATUSES = {
+	"anime": ("Watching", "Completed", "Plan to Watch", "On-Hold", "Dropped", "Re-Watching"),
+	"manga": ("Reading", "Completed", "Plan to Read", "On-Hold", "Dropped", "Re-Reading")
+}
+
+UNITS = { "anime": "episodes", "manga": "chapters" }
+
+# A user and the items of his feeds, the newest first
+class FakeUser:
+	def __init__(self, name, next_update):
+		self.name        = name
+		self.next_update = next_update
+		self.items       = { "anime": [], "manga": [] }
+
+class FakeMAL:
+	def __init__(self, users=1000, medias=5000, updates_per_hour=1, backlog=3600, latency=0, error_rate=0, broken_rate=0, page_size=65536, seed=0):
+		self.random      = random.Random(seed)
+		self.medias      = medias
+		self.latency     = latency
+		self.error_rate  = error_rate
+		self.broken_rate = broken_rate
+		self.base_url    = ""
+
+		# Mean delay between two updates of a user, None if the users never update their lists
+		self.interval = 3600 / updates_per_hour if updates_per_hour > 0 else None
+
+		# Filler put before the thumbnail in the media pages, they are as heavy as the real ones
+		self.filler = ("<div class=\"spaceit_pad\">" + "Lorem ipsum dolor sit amet. " * 8 + "</div>\n") * (page_size // 256 + 1)
+
+		# Number of requests by route, and number of items generated
+		self.requests  = {}
+		self.generated = 0
+
+		self.users = {}
+		now = time.time()
+
+		for i in range(users):
+			user = FakeUser("user" + str(i), self._next_update(now - backlog))
+
+			# Old items, never announced, so the feeds have their usual size
+			for media in user.items:
+				user.items[media] = [self._item(media, now - 86400 * (30 + j)) for j in range(FEED_SIZE)]
+
+			self.users[user.name] = user
+
+	def user_names(self):
+		return list(self.users)
+
+	def _next_update(self, start):
+		if self.interval is None: return None
+		return start + self.random.expovariate(1 / self.interval)
+
+	def _item(self, media, published):
+		media_id = self.random.randrange(1, self.medias + 1)
+		status = self.random.choice(STATUSES[media])
+		total = self.random.randint(1, 100)
+
+		return (published, media_id, status, self.random.randint(0, total), total)
+
+	# Add the updates of a user since his last request
+	def _update(self, user):
+		now = time.time()
+
+		while user.next_update is not None and user.next_update <= now:
+			media = self.random.choice(("anime", "manga"))
+			items = user.items[media]
+
+			items.insert(0, self._item(media, user.next_update))
+			del items[FEED_SIZE:]
+
+			self.generated += 1
+			user.next_update = self._next_update(user.next_update)
+
+	def _broken(self, media_id):
+		return (media_id * 2654435761) % 1000 < self.broken_rate * 1000
+
+	def media_url(self, media, media_id):
+		return self.base_url + "/" + media + "/" + str(media_id) + "/Media_" + str(media_id)
+
+	def image_url(self, media, media_id):
+		return self.base_url + "/images/" + media + "/" + str(media_id) + ".jpg"
+
+	def render_feed(self, user, media):
+		lines = [
+			"<?xml version=\"1.0\" encoding=\"utf-8\" ?>",
+			"<rss version=\"2.0\">",
+			"<channel>",
+			"<title>" + user.name + "'s Recent " + media.capitalize() + "</title>",
+			"<link>" + self.base_url + "/profile/" + user.name + "</link>",
+			"<description>Recent " + media.capitalize() + " updates by " + user.name + "</description>"
+		]
+
+		for published, media_id, status, progress, total in user.items[media]:
+			url = self.media_url(media, media_id)
+
+			# The rewatches are shown with a leading dash, like on MyAnimeList
+			if status.startswith("Re-"): description = "- " + str(progress) + " of " + str(total) + " " + UNITS[media]
+			else: description = status + " - " + str(progress) + " of " + str(total) + " " + UNITS[media]
+
+			lines += [
+				"<item>",
+				"<title>Media " + str(media_id) + (" - TV" if media == "anime" else " - Manga") + "</title>",
+				"<link>" + url + "</link>",
+				"<guid>" + url + "</guid>",
+				"<description><![CDATA[" + description + "]]></description>",
+				"<pubDate>" + email.utils.format_datetime(datetime.fromtimestamp(published, MAL_TIMEZONE)) + "</pubDate>",
+				"</item>"
+			]
+
+		lines += ["</channel>", "</rss>"]
+
+		return "\n".join(lines).encode("utf-8")
+
+	@web.middleware
+	async def middleware(self, request, handler):
+		route = request.path.split("/")[1]
+		self.requests[route] = self.requests.get(route, 0) + 1
+
+		if self.latency > 0: await asyncio.sleep(self.latency)
+
+		# Throttling, the images are served by the CDN
+		if route != "images" and self.random.random() < self.error_rate:
+			return web.Response(status=503, headers={ "Retry-After": "1" })
+
+		return await handler(request)
+
+	async def get_feed(self, request):
+		user = self.users.get(request.query.get("u", "").lower())
+		if user is None: raise web.HTTPNotFound()
+
+		media = "manga" if request.query.get("type") == "rm" else "anime"
+		self._update(user)
+
+		items = user.items[media]
+		etag = "\"" + str(int(items[0][0] * 1000) if len(items) > 0 else 0) + "\""
+
+		if request.headers.get("If-None-Match") == etag: return web.Response(status=304, headers={ "ETag": etag })
+
+		return web.Response(body=self.render_feed(user, media), content_type="application/rss+xml", charset="utf-8", headers={ "ETag": etag })
+
+	async def get_media(self, request):
+		media = request.match_info["media"]
+		media_id = int(request.match_info["id"])
+		image = self.image_url(media, media_id)
+
+		page = "<!DOCTYPE html>\n<html>\n<head>\n<meta property=\"og:image\" content=\"" + image + "\">\n</head>\n<body>\n" + self.filler
+		page += "<img class=\"lazyloaded\" src=\"" + image + "\" alt=\"Media " + str(media_id) + "\" itemprop=\"image\">\n" + self.filler + "</body>\n</html>\n"
+
+		return web.Response(text=page, content_type="text/html")
+
+	async def get_image(self, request):
+		if self._broken(int(request.match_info["id"])): raise web.HTTPNotFound()
+
+		return web.Response(body=b"\xff\xd8\xff\xe0" + bytes(2048), content_type="image/jpeg")
+
+	async def get_profile(self, request):
+		if request.match_info["user"].lower() not in self.users: raise web.HTTPNotFound()
+
+		return web.Response(text="<html><body>" + request.match_info["user"] + "</body></html>", content_type="text/html")
+
+	def application(self):
+		application = web.Application(middlewares=[self.middleware])
+		application.router.add_get("/rss.php", self.get_feed)
+		application.router.add_get("/profile/{user}", self.get_profile)
+		application.router.add_get("/images/{media}/{id:\\d+}.jpg", self.get_image)
+		application.router.add_get("/{media:anime|manga}/{id:\\d+}", self.get_media)
+		application.router.add_get("/{media:anime|manga}/{id:\\d+}/{name}", self.get_media)
+
+		return application
+
+	# Serve on http://host:port, return the runner to stop it with runner.cleanup()
+	async def start(self, host, port):
+		self.base_url = "http://" + host + ":" + str(port)
+
+		runner = web.AppRunner(self.application())
+		await runner.setup()
+		await web.TCPSite(runner, host, port).start()
+
+		return runner
+
+def main():
+	parser = argparse.ArgumentParser(description="Stand-in for MyAnimeList")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8181)
+	parser.add_argument("--users", type=int, default=1000, help="users, named user0, user1...")
+	parser.add_argument("--medias", type=int, default=5000, help="different medias in the feeds")
+	parser.add_argument("--updates-per-hour", type=float, default=1, help="updates of each user, on average")
+	parser.add_argument("--backlog", type=int, default=3600, help="seconds of updates already in the feeds at startup")
+	parser.add_argument("--latency", type=float, default=0, help="delay of each response, in seconds")
+	parser.add_argument("--error-rate", type=float, default=0, help="part of the responses being a 503")
+	parser.add_argument("--broken-rate", type=float, default=0, help="part of the thumbnails being a 404")
+	parser.add_argument("--page-size", type=int, default=65536, help="size of the media pages, in bytes")
+	args = parser.parse_args()
+
+	fake = FakeMAL(args.users, args.medias, args.updates_per_hour, args.backlog, args.latency, args.error_rate, args.broken_rate, args.page_size)
+
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(fake.start(args.host, args.port))
+
+	print("Serving " + str(args.users) + " users on " + fake.base_url)
+
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		print("Requests: " + str(fake.requests) + ", items generated: " + str(fake.generated))
+
+if __name__ == "__main__":
+	main()
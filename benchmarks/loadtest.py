@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# Copyright Penta (c) 2018/2020 - Under BSD License
+
+# Compatible for Python 3.7.X
+#
+# Load test of the bot, without MyAnimeList nor Discord: the feeds are checked against
+# the stand-in of benchmarks/fakemal.py and the messages are sent to a fake Discord client
+# recording them. It reports the time needed to check all the users once, the items
+# announced per second and the database transactions per item, then measures the check
+# of the thumbnail catalog and the download of the media pages.
+#
+# The database must be a throwaway one created with extra/initDB.sql, its users, servers,
+# feeds and medias are deleted! The configuration is a normal configuration of the bot
+# pointing to this database, the options needed by the test are overridden.
+# To be started from the root of the repository:
+#
+# mysql -e "CREATE DATABASE myanimebot_test" && mysql myanimebot_test < extra/initDB.sql
+# python3 benchmarks/loadtest.py --config loadtest.conf --reset --users 1000 --duration 120
+
+# Library import
+import argparse
+import asyncio
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import mariadb
+
+from configparser import ConfigParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+sys.path.append(BENCHMARKS_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "include"))
+
+import fakemal
+
+# Tables emptied before the test
+TABLES = ["t_feeds", "t_animes", "t_users_servers", "t_users", "t_servers", "t_feed_state", "t_stats_titles", "t_stats_totals", "t_stats_users", "t_workers"]
+
+# Channel of Discord recording the messages sent by the bot
+class FakeChannel:
+	def __init__(self, client, id):
+		self.client = client
+		self.id     = id
+
+	async def send(self, **message):
+		if self.client.latency > 0: await asyncio.sleep(self.client.latency)
+
+		self.client.messages += 1
+		self.client.embeds += len(message["embeds"]) if "embeds" in message else 1
+
+# Replace the Discord client of the send queue
+class FakeDiscord:
+	def __init__(self, latency=0):
+		self.latency  = latency
+		self.channels = {}
+		self.messages = 0
+		self.embeds   = 0
+
+	def get_channel(self, id):
+		return self.channels.setdefault(id, FakeChannel(self, id))
+
+	async def fetch_channel(self, id):
+		return self.get_channel(id)
+
+# Write the configuration of the bot into directory, with the options of the test
+def write_config(args, directory):
+	config = ConfigParser()
+	config.read(args.config)
+
+	config["MYANIMEBOT"].update({
+		"malUrl": "http://127.0.0.1:" + str(args.port) if args.mal_url is None else args.mal_url,
+		"token": "loadtest",
+		"logLevel": "WARNING",
+		"logPath": os.path.join(directory, "loadtest.log"),
+		"discordGateway": "false",
+		"sharding": "false",
+		"metricsPort": "0",
+		"thumbnailStorePath": "",
+		"requestsPerSecond": str(args.requests_per_second),
+		"thumbnailRequestsPerSecond": "0",
+		"maxConcurrentUsers": str(args.concurrency),
+		"pollMinInterval": str(args.poll_interval),
+		"pollMaxInterval": str(args.poll_interval),
+		"thumbnailMaxAge": "0"
+	})
+
+	with open(os.path.join(directory, "myanimebot.conf"), "w") as config_file:
+		config.write(config_file)
+
+	return config["MYANIMEBOT"]
+
+# Empty the database, then add the users and the servers displaying them
+def prepare_database(config, users, servers, servers_per_user):
+	conn = mariadb.connect(host=config.get("dbHost", "127.0.0.1"), user=config.get("dbUser", "myanimebot"), password=config.get("dbPassword"), database=config.get("dbName", "myanimebot"))
+	cursor = conn.cursor()
+
+	for table in TABLES: cursor.execute("DELETE FROM " + table)
+
+	cursor.executemany("INSERT INTO t_servers (server, channel) VALUES (%s, %s)", [[str(1000000 + i), str(2000000 + i)] for i in range(servers)])
+	cursor.executemany("INSERT INTO t_users (mal_user, service) VALUES (%s, 'mal')", [[user] for user in users])
+
+	cursor.execute("SELECT id FROM t_users")
+	links = [[data[0], str(1000000 + server)] for data in cursor.fetchall() for server in random.sample(range(servers), min(servers, servers_per_user))]
+	cursor.executemany("INSERT INTO t_users_servers (user_id, server) VALUES (%s, %s)", links)
+
+	conn.commit()
+	conn.close()
+
+# Import the bot without starting it, it reads the configuration of the current directory
+def load_bot():
+	spec = importlib.util.spec_from_file_location("myanimebot", os.path.join(ROOT_DIR, "myanimebot.py"))
+	bot = importlib.util.module_from_spec(spec)
+
+	sys.modules["myanimebot"] = bot
+	spec.loader.exec_module(bot)
+
+	return bot
+
+def count(histogram):
+	return sum(counts[-1] for counts in histogram.values.values())
+
+def seconds(histogram):
+	return sum(counts[-2] for counts in histogram.values.values())
+
+def total(counter, **labels):
+	return counter.values.get(counter._key(labels), 0)
+
+async def wait_sends(bot):
+	while len(bot.sendQueue.tasks) > 0: await asyncio.sleep(0.1)
+
+async def run(args, bot, fake, discord):
+	database = bot.database
+	runner = None
+	if args.mal_url is None: runner = await fake.start("127.0.0.1", args.port)
+
+	users = len(fake.users)
+	start = time.perf_counter()
+	task = asyncio.ensure_future(bot.background_check_feed())
+
+	# All the users are due at startup
+	while count(bot.POLL_SECONDS) < users and not task.done(): await asyncio.sleep(0.1)
+
+	sweep = time.perf_counter() - start
+	await asyncio.sleep(args.duration)
+
+	task.cancel()
+	await wait_sends(bot)
+
+	elapsed = time.perf_counter() - start
+	polls = count(bot.POLL_SECONDS)
+	announced = total(bot.FEED_ITEMS, stage="announced")
+	queries = count(database.QUERY_SECONDS)
+
+	print("Feeds: %d users, %d checks" % (users, polls) + ("" if runner is None else ", %d items generated" % fake.generated))
+	print("  first sweep %.1fs (%.1f users/s), %.1f checks/s over %.1fs" % (sweep, users / sweep, polls / elapsed, elapsed))
+	print("  %d items seen, %d new, %d announced (%.2f items/s)" % (total(bot.FEED_ITEMS, stage="seen"), total(bot.FEED_ITEMS, stage="new"), announced, announced / elapsed))
+	print("  mean check %.1f ms, mean delay before a check %.1f ms" % (1000 * seconds(bot.POLL_SECONDS) / max(1, polls), 1000 * seconds(bot.POLL_DELAY) / max(1, count(bot.POLL_DELAY))))
+	print("  %d database transactions (%.2f per item, %.2f per check)" % (queries, queries / max(1, announced), queries / max(1, polls)))
+	print("  Discord: %d messages, %d embeds" % (discord.messages, discord.embeds))
+
+	# The transactions taking the most time
+	statements = sorted(database.QUERY_SECONDS.values.items(), key=lambda value: -value[1][-2])
+
+	for key, counts in statements[:args.statements]:
+		print("    %6d x %7.2f ms  %s" % (counts[-1], 1000 * counts[-2] / counts[-1], key[0][:100]))
+
+	# Check of the thumbnails of all the medias found
+	start = time.perf_counter()
+	verified, updated = await bot.check_thumbnail_catalog()
+	elapsed = time.perf_counter() - start
+
+	print("Thumbnail catalog: %d verified, %d updated in %.1fs (%.1f thumbnails/s)" % (verified, updated, elapsed, verified / elapsed))
+
+	# Download of the media pages, as many at once as the HTTP connections allow
+	semaphore = asyncio.Semaphore(bot.httpMaxConnectionsPerHost)
+	ids = random.sample(range(1, fake.medias + 1), min(fake.medias, args.pages))
+
+	async def get_thumbnail(media_id):
+		async with semaphore:
+			return await bot.utils.getThumbnailAsync(bot.get_http_session(), bot.malUrl + "/anime/" + str(media_id) + "/Media_" + str(media_id))
+
+	start = time.perf_counter()
+	thumbnails = await asyncio.gather(*[get_thumbnail(media_id) for media_id in ids])
+	elapsed = time.perf_counter() - start
+
+	found = sum(1 for media_id, thumbnail in zip(ids, thumbnails) if thumbnail is not None and thumbnail.endswith("/" + str(media_id) + ".jpg"))
+
+	print("Media pages: %d downloaded in %.1fs (%.1f pages/s), %d thumbnails found" % (len(ids), elapsed, len(ids) / elapsed, found))
+	if args.mal_url is None: print("Requests served: " + str(fake.requests))
+
+	if args.metrics is not None: bot.metrics.REGISTRY.write(args.metrics)
+
+	await bot.client.close()
+	if runner is not None: await runner.cleanup()
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test of the checks of the feeds")
+	parser.add_argument("--config", required=True, help="configuration of the bot, pointing to a throwaway database")
+	parser.add_argument("--reset", action="store_true", help="confirm the database can be emptied")
+	parser.add_argument("--users", type=int, default=1000)
+	parser.add_argument("--servers", type=int, default=100)
+	parser.add_argument("--servers-per-user", type=int, default=1)
+	parser.add_argument("--medias", type=int, default=5000)
+	parser.add_argument("--updates-per-hour", type=float, default=2, help="updates of each user, on average")
+	parser.add_argument("--latency", type=float, default=0.05, help="delay of the responses of MyAnimeList, in seconds")
+	parser.add_argument("--error-rate", type=float, default=0, help="part of the responses of MyAnimeList being a 503")
+	parser.add_argument("--broken-rate", type=float, default=0.1, help="part of the thumbnails being a 404")
+	parser.add_argument("--discord-latency", type=float, default=0.1, help="delay of the messages sent to Discord, in seconds")
+	parser.add_argument("--port", type=int, default=8181, help="port of the stand-in for MyAnimeList")
+	parser.add_argument("--mal-url", help="use a stand-in already running (benchmarks/fakemal.py) instead of starting one")
+	parser.add_argument("--requests-per-second", type=float, default=0, help="requestsPerSecond of the bot, 0 for no limit")
+	parser.add_argument("--concurrency", type=int, default=4, help="maxConcurrentUsers of the bot")
+	parser.add_argument("--poll-interval", type=int, default=30, help="interval between two checks of a user, in seconds")
+	parser.add_argument("--duration", type=float, default=60, help="seconds of test after the first sweep")
+	parser.add_argument("--pages", type=int, default=200, help="media pages downloaded")
+	parser.add_argument("--statements", type=int, default=10, help="slowest transactions displayed")
+	parser.add_argument("--metrics", help="file where all the metrics are written at the end")
+	args = parser.parse_args()
+
+	if not args.reset:
+		print("The users, servers, feeds and medias of the database will be deleted, add --reset to confirm.")
+		exit(1)
+
+	args.config = os.path.abspath(args.config)
+	if args.metrics is not None: args.metrics = os.path.abspath(args.metrics)
+
+	fake = fakemal.FakeMAL(args.users, args.medias, args.updates_per_hour, latency=args.latency, error_rate=args.error_rate, broken_rate=args.broken_rate)
+	directory = tempfile.mkdtemp(prefix="myanimebot-loadtest-")
+
+	config = write_config(args, directory)
+	prepare_database(config, fake.user_names(), args.servers, args.servers_per_user)
+
+	os.chdir(directory)
+	bot = load_bot()
+
+	discord = FakeDiscord(args.discord_latency)
+	bot.sendQueue.client = discord
+
+	# discord.py 2.x creates its loop at login, the older versions with the client
+	if hasattr(bot.discord.Client, "setup_hook"): asyncio.run(run(args, bot, fake, discord))
+	else: bot.client.loop.run_until_complete(run(args, bot, fake, discord))
+
+	bot.db.close()
+	bot.logdb.close()
+
+	print("Logs of the bot: " + os.path.join(directory, "loadtest.log"))
+
+if __name__ == "__main__":
+	main()
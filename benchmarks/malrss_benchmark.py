@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright Penta (c) 2018/2020 - Under BSD License
+
+# Compatible for Python 3.7.X
+#
+# Compare the MyAnimeList RSS parser of the bot (include/malrss.py) with feedparser,
+# dates included. To be started from the root of the repository:
+# python3 benchmarks/malrss_benchmark.py [feed.xml ...]
+#
+# Without argument, the feeds of benchmarks/feeds/ are used. They are synthetic, written in
+# the format of rss.php: rm_sample.xml and rw_sample.xml are plain feeds of 50 items,
+# entities_sample.xml has the XML entities and the markup in the descriptions that malrss
+# parses itself, html_entities_sample.xml has HTML entities (&rsquo;) that malrss hands
+# to feedparser. Captured feeds of MyAnimeList can be given as arguments.
+
+# Library import
+import glob
+import os
+import sys
+import timeit
+import pytz
+import feedparser
+
+from datetime import datetime
+from xml.etree.ElementTree import ParseError
+
+# Custom library
+sys.path.append('include/')
+import malrss
+
+# Number of times each feed is parsed
+ROUNDS = 200
+
+timezone = pytz.timezone("Europe/Paris")
+
+def with_feedparser(data):
+	for item in feedparser.parse(data).entries:
+		pubDateRaw = datetime.strptime(item.published, '%a, %d %b %Y %H:%M:%S %z').astimezone(timezone)
+		pubDate = pubDateRaw.strftime("%Y-%m-%d %H:%M:%S")
+
+def with_malrss(dates, data):
+	for item in malrss.parse(data):
+		pubDateRaw, pubDate = dates.parse(item.published)
+
+def main():
+	paths = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "feeds", "*.xml")))
+	dates = malrss.DateParser(timezone)
+
+	for path in paths:
+		with open(path, "rb") as feed_file:
+			data = feed_file.read()
+
+		# Both parsers must find the same items
+		expected = [(item.title, item.link, item.description, item.published) for item in feedparser.parse(data).entries]
+		found = [(item.title, item.link, item.description, item.published) for item in malrss.parse(data)]
+
+		if expected != found: print(os.path.basename(path) + ": the parsers don't agree!")
+
+		# The feeds malrss can't read are parsed by feedparser, as slow as the reference
+		try:
+			malrss._parse(data)
+			fallback = ""
+		except (ParseError, KeyError, ValueError) as e:
+			fallback = ", parsed by feedparser (" + str(e) + ")"
+
+		reference = timeit.timeit(lambda: with_feedparser(data), number=ROUNDS) / ROUNDS
+		fast = timeit.timeit(lambda: with_malrss(dates, data), number=ROUNDS) / ROUNDS
+
+		print("%s: %d items, feedparser %.3f ms, malrss %.3f ms (x%.1f)%s" % (os.path.basename(path), len(found), reference * 1000, fast * 1000, reference / fast, fallback))
+
+if __name__ == "__main__":
+	main()
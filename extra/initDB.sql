@@ -374,7 +374,7 @@ CREATE PROCEDURE `sp_Maintenance`()
 BEGIN
 
 # Analyzing database's tables.
-ANALYZE TABLE t_animes, t_feeds, t_history, t_servers, t_sys, t_users, t_logs, t_availability;
+ANALYZE TABLE t_animes, t_feeds, t_history, t_servers, t_stats_titles, t_stats_totals, t_stats_users, t_sys, t_users, t_users_servers, t_logs, t_availability;
 
 END//
 DELIMITER ;
@@ -407,6 +407,15 @@ UPDATE t_feeds
 	SET t_feeds.user = new_name_var
 	WHERE t_feeds.user = old_name_var;
 
+-- For the statistics, computed again from t_feeds as both users may have some
+DELETE FROM t_stats_users WHERE user IN (old_name_var, new_name_var);
+DELETE FROM t_stats_titles WHERE user IN (old_name_var, new_name_var);
+
+INSERT INTO t_stats_users (user, total)
+	SELECT user, COUNT(title) FROM t_feeds WHERE user = new_name_var GROUP BY user;
+
+INSERT INTO t_stats_titles (title, user, total)
+	SELECT title, user, COUNT(0) FROM t_feeds WHERE user = new_name_var AND title IS NOT NULL GROUP BY title, user;
 
 END//
 DELIMITER ;
@@ -447,12 +456,12 @@ THEN SET limit_var = '-1';
 END IF;
 
 -- Statistics of users according to a specific keyword
-SELECT user AS 'user', COUNT(title) AS 'total'
+SELECT user AS 'user', SUM(total) AS 'total'
 
-   FROM t_feeds
+   FROM t_stats_titles
    WHERE MATCH(title) AGAINST(anime_var)
    GROUP BY user
-   ORDER BY COUNT(title) DESC
+   ORDER BY SUM(total) DESC
    LIMIT limit_var
 ;
 
@@ -469,11 +478,13 @@ CREATE TABLE IF NOT EXISTS `t_animes` (
   `found` datetime NOT NULL DEFAULT current_timestamp(),
   `discoverer` tinytext DEFAULT 'Anonymous',
   `media` tinytext DEFAULT 'unknown',
+  `thumbnail_checked` datetime DEFAULT NULL,
   PRIMARY KEY (`id`),
   UNIQUE KEY `idx_guid` (`guid`(768)) USING BTREE,
   KEY `idx_title` (`title`(768)),
   KEY `idx_discoverer` (`discoverer`(255)),
   KEY `idx_media` (`media`(255)),
+  KEY `idx_thumbnail_checked` (`thumbnail_checked`),
   FULLTEXT KEY `idx_title_str` (`title`)
 ) ENGINE=InnoDB AUTO_INCREMENT=3329 DEFAULT CHARSET=utf8mb4 AVG_ROW_LENGTH=224;
 
@@ -492,6 +503,19 @@ CREATE TABLE IF NOT EXISTS `t_availability` (
 
 -- Data exporting was unselected.
 
+-- Dumping structure for table myanimebot.t_feed_state
+CREATE TABLE IF NOT EXISTS `t_feed_state` (
+  `user` tinytext NOT NULL,
+  `media` tinytext NOT NULL,
+  `etag` tinytext DEFAULT NULL,
+  `last_modified` tinytext DEFAULT NULL,
+  `last_published_utc` datetime DEFAULT NULL,
+  `updated` datetime NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`user`(255),`media`(16)) USING BTREE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='HTTP validators and newest item processed of the RSS feeds of each user';
+
+-- Data exporting was unselected.
+
 -- Dumping structure for table myanimebot.t_feeds
 CREATE TABLE IF NOT EXISTS `t_feeds` (
   `id` int(11) unsigned NOT NULL AUTO_INCREMENT,
@@ -503,6 +527,7 @@ CREATE TABLE IF NOT EXISTS `t_feeds` (
   `found` datetime NOT NULL DEFAULT current_timestamp(),
   `type` tinytext DEFAULT 'N/A',
   PRIMARY KEY (`id`),
+  UNIQUE KEY `idx_feed` (`user`(255),`published`,`title`(255)),
   KEY `idx_user` (`user`(255)),
   KEY `idx_title` (`title`(768)),
   KEY `idx_published` (`published`),
@@ -570,6 +595,36 @@ CREATE TABLE IF NOT EXISTS `t_servers` (
 
 -- Data exporting was unselected.
 
+-- Dumping structure for table myanimebot.t_stats_titles
+CREATE TABLE IF NOT EXISTS `t_stats_titles` (
+  `title` mediumtext NOT NULL,
+  `user` tinytext NOT NULL,
+  `total` int(11) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`title`(255),`user`(255)) USING BTREE,
+  FULLTEXT KEY `idx_title_str` (`title`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Number of feeds per title and user, updated with t_feeds';
+
+-- Data exporting was unselected.
+
+-- Dumping structure for table myanimebot.t_stats_totals
+CREATE TABLE IF NOT EXISTS `t_stats_totals` (
+  `name` varchar(32) NOT NULL,
+  `total` bigint(20) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Total of feeds and medias, updated with t_feeds and t_animes';
+
+-- Data exporting was unselected.
+
+-- Dumping structure for table myanimebot.t_stats_users
+CREATE TABLE IF NOT EXISTS `t_stats_users` (
+  `user` tinytext NOT NULL,
+  `total` int(11) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`user`(255)) USING BTREE,
+  KEY `idx_total` (`total`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Number of feeds per user, updated with t_feeds';
+
+-- Data exporting was unselected.
+
 -- Dumping structure for table myanimebot.t_sys
 CREATE TABLE IF NOT EXISTS `t_sys` (
   `param` tinytext NOT NULL,
@@ -584,17 +639,36 @@ CREATE TABLE IF NOT EXISTS `t_users` (
   `id` int(11) unsigned NOT NULL AUTO_INCREMENT,
   `mal_user` tinytext NOT NULL,
   `service` tinytext NOT NULL DEFAULT 'mal',
-  `servers` text DEFAULT NULL,
   `added` datetime NOT NULL DEFAULT current_timestamp(),
   PRIMARY KEY (`id`),
   UNIQUE KEY `idx_user` (`mal_user`(255)) USING BTREE,
-  KEY `idx_servers` (`servers`(768)),
-  KEY `idx_service` (`service`(255)),
-  FULLTEXT KEY `idx_servers_str` (`servers`)
+  KEY `idx_service` (`service`(255))
 ) ENGINE=InnoDB AUTO_INCREMENT=27 DEFAULT CHARSET=utf8mb4 AVG_ROW_LENGTH=1820 COMMENT='Table where are stored the users of this bot.';
 
 -- Data exporting was unselected.
 
+-- Dumping structure for table myanimebot.t_users_servers
+CREATE TABLE IF NOT EXISTS `t_users_servers` (
+  `user_id` int(11) unsigned NOT NULL,
+  `server` tinytext NOT NULL,
+  `added` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`user_id`,`server`(32)) USING BTREE,
+  KEY `idx_server` (`server`(32),`user_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Servers where each user is displayed.';
+
+-- Data exporting was unselected.
+
+-- Dumping structure for table myanimebot.t_workers
+CREATE TABLE IF NOT EXISTS `t_workers` (
+  `worker` varchar(255) NOT NULL,
+  `heartbeat` datetime NOT NULL DEFAULT current_timestamp(),
+  `gateway` tinyint(1) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`worker`),
+  KEY `idx_heartbeat` (`heartbeat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Running instances of the bot sharing the users';
+
+-- Data exporting was unselected.
+
 -- Dumping structure for view myanimebot.v_ActiveUsers
 -- Creating temporary table to overcome VIEW dependency errors
 CREATE TABLE `v_ActiveUsers` (
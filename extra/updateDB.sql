@@ -0,0 +1,189 @@
+-- --------------------------------------------------------
+-- Upgrade of an existing MyAnimeBot database.
+-- Every statement can be run again safely, apply this file after each update of the bot.
+-- --------------------------------------------------------
+
+USE `myanimebot`;
+
+-- HTTP validators of the RSS feeds, used for conditional requests
+CREATE TABLE IF NOT EXISTS `t_feed_state` (
+  `user` tinytext NOT NULL,
+  `media` tinytext NOT NULL,
+  `etag` tinytext DEFAULT NULL,
+  `last_modified` tinytext DEFAULT NULL,
+  `updated` datetime NOT NULL DEFAULT current_timestamp() ON UPDATE current_timestamp(),
+  PRIMARY KEY (`user`(255),`media`(16)) USING BTREE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='HTTP validators of the RSS feeds of each user';
+
+-- Servers where each user is displayed, replacing the comma-separated t_users.servers column
+CREATE TABLE IF NOT EXISTS `t_users_servers` (
+  `user_id` int(11) unsigned NOT NULL,
+  `server` tinytext NOT NULL,
+  `added` datetime NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`user_id`,`server`(32)) USING BTREE,
+  KEY `idx_server` (`server`(32),`user_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Servers where each user is displayed.';
+
+-- Move the content of t_users.servers into t_users_servers, then drop the column (and its indexes)
+DELIMITER //
+BEGIN NOT ATOMIC
+	IF EXISTS (SELECT 1 FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 't_users' AND COLUMN_NAME = 'servers') THEN
+		INSERT IGNORE INTO t_users_servers (user_id, server)
+			SELECT t_users.id, TRIM(SUBSTRING_INDEX(SUBSTRING_INDEX(t_users.servers, ',', seq_1_to_1000.seq), ',', -1))
+			FROM t_users
+			JOIN seq_1_to_1000 ON seq_1_to_1000.seq <= 1 + LENGTH(t_users.servers) - LENGTH(REPLACE(t_users.servers, ',', ''))
+			WHERE t_users.servers IS NOT NULL AND t_users.servers != '';
+		
+		ALTER TABLE t_users DROP COLUMN servers;
+	END IF;
+END//
+DELIMITER ;
+
+-- Last time each thumbnail has been found alive
+ALTER TABLE `t_animes`
+	ADD COLUMN IF NOT EXISTS `thumbnail_checked` datetime DEFAULT NULL AFTER `media`,
+	ADD INDEX IF NOT EXISTS `idx_thumbnail_checked` (`thumbnail_checked`);
+
+-- A feed item is stored only once: the duplicates are removed, then the unique key is added
+DELETE t_feeds FROM t_feeds
+	JOIN (
+		SELECT MIN(id) AS id, user, published, LEFT(title, 255) AS title
+		FROM t_feeds
+		GROUP BY user, published, LEFT(title, 255)
+		HAVING COUNT(0) > 1
+	) AS duplicates ON t_feeds.user = duplicates.user AND t_feeds.published = duplicates.published AND LEFT(t_feeds.title, 255) = duplicates.title AND t_feeds.id > duplicates.id;
+
+ALTER TABLE `t_feeds`
+	ADD UNIQUE INDEX IF NOT EXISTS `idx_feed` (`user`(255), `published`, `title`(255));
+
+-- Statistics of the top command, kept up to date by the bot when it stores a feed
+CREATE TABLE IF NOT EXISTS `t_stats_titles` (
+  `title` mediumtext NOT NULL,
+  `user` tinytext NOT NULL,
+  `total` int(11) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`title`(255),`user`(255)) USING BTREE,
+  FULLTEXT KEY `idx_title_str` (`title`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Number of feeds per title and user, updated with t_feeds';
+
+CREATE TABLE IF NOT EXISTS `t_stats_totals` (
+  `name` varchar(32) NOT NULL,
+  `total` bigint(20) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Total of feeds and medias, updated with t_feeds and t_animes';
+
+CREATE TABLE IF NOT EXISTS `t_stats_users` (
+  `user` tinytext NOT NULL,
+  `total` int(11) unsigned NOT NULL DEFAULT 0,
+  PRIMARY KEY (`user`(255)) USING BTREE,
+  KEY `idx_total` (`total`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Number of feeds per user, updated with t_feeds';
+
+-- Fill the statistics from the current history (computed again on each run)
+INSERT INTO t_stats_users (user, total)
+	SELECT user, COUNT(title) FROM t_feeds WHERE user IS NOT NULL GROUP BY user
+	ON DUPLICATE KEY UPDATE total = VALUES(total);
+
+INSERT INTO t_stats_titles (title, user, total)
+	SELECT title, user, COUNT(0) FROM t_feeds WHERE user IS NOT NULL AND title IS NOT NULL GROUP BY title, user
+	ON DUPLICATE KEY UPDATE total = VALUES(total);
+
+INSERT INTO t_stats_totals (name, total) SELECT 'feeds', COUNT(0) FROM t_feeds ON DUPLICATE KEY UPDATE total = VALUES(total);
+INSERT INTO t_stats_totals (name, total) SELECT 'animes', COUNT(0) FROM t_animes ON DUPLICATE KEY UPDATE total = VALUES(total);
+
+-- The keyword statistics and the renaming of a user use the new tables
+DROP PROCEDURE IF EXISTS `sp_UsersPerKeyword`;
+DELIMITER //
+CREATE PROCEDURE `sp_UsersPerKeyword`(
+	IN `anime_var` TINYTEXT,
+	IN `limit_var` INT
+)
+    READS SQL DATA
+    SQL SECURITY INVOKER
+    COMMENT 'Statistiques des utilisateurs par rapport à un mot clef'
+BEGIN
+
+-- Default value is infinite for limit_var
+IF limit_var = ''
+THEN SET limit_var = '-1';
+END IF;
+
+-- Statistics of users according to a specific keyword
+SELECT user AS 'user', SUM(total) AS 'total'
+
+   FROM t_stats_titles
+   WHERE MATCH(title) AGAINST(anime_var)
+   GROUP BY user
+   ORDER BY SUM(total) DESC
+   LIMIT limit_var
+;
+
+END//
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS `sp_RenameUser`;
+DELIMITER //
+CREATE PROCEDURE `sp_RenameUser`(
+	IN `old_name_var` TINYTEXT,
+	IN `new_name_var` TINYTEXT
+)
+    MODIFIES SQL DATA
+    SQL SECURITY INVOKER
+    COMMENT 'Rename a user in the database.'
+BEGIN
+
+-- Rename a user in the database.
+
+-- For the table t_users
+UPDATE t_users
+	SET t_users.mal_user = new_name_var
+	WHERE t_users.mal_user = old_name_var;
+
+-- For the table t_animes
+UPDATE t_animes
+	SET t_animes.discoverer = new_name_var
+	WHERE t_animes.discoverer = old_name_var;
+
+-- For the table t_feeds
+UPDATE t_feeds
+	SET t_feeds.user = new_name_var
+	WHERE t_feeds.user = old_name_var;
+
+-- For the statistics, computed again from t_feeds as both users may have some
+DELETE FROM t_stats_users WHERE user IN (old_name_var, new_name_var);
+DELETE FROM t_stats_titles WHERE user IN (old_name_var, new_name_var);
+
+INSERT INTO t_stats_users (user, total)
+	SELECT user, COUNT(title) FROM t_feeds WHERE user = new_name_var GROUP BY user;
+
+INSERT INTO t_stats_titles (title, user, total)
+	SELECT title, user, COUNT(0) FROM t_feeds WHERE user = new_name_var AND title IS NOT NULL GROUP BY title, user;
+
+END//
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS `sp_Maintenance`;
+DELIMITER //
+CREATE PROCEDURE `sp_Maintenance`()
+BEGIN
+
+# Analyzing database's tables.
+ANALYZE TABLE t_animes, t_feeds, t_history, t_servers, t_stats_titles, t_stats_totals, t_stats_users, t_sys, t_users, t_users_servers, t_logs, t_availability;
+
+END//
+DELIMITER ;
+
+-- Newest item processed in each feed (in UTC), the older items are not checked again.
+-- The marks saved in local time by the previous versions are dropped, the feeds are checked in full once.
+ALTER TABLE `t_feed_state`
+	DROP COLUMN IF EXISTS `last_published`,
+	ADD COLUMN IF NOT EXISTS `last_published_utc` datetime DEFAULT NULL AFTER `last_modified`,
+	COMMENT='HTTP validators and newest item processed of the RSS feeds of each user';
+
+-- Running instances of the bot, used to share the users when sharding is enabled
+CREATE TABLE IF NOT EXISTS `t_workers` (
+  `worker` varchar(255) NOT NULL,
+  `heartbeat` datetime NOT NULL DEFAULT current_timestamp(),
+  `gateway` tinyint(1) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`worker`),
+  KEY `idx_heartbeat` (`heartbeat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='Running instances of the bot sharing the users';
@@ -0,0 +1,99 @@
+import asyncio
+import re
+import time
+import mariadb
+
+import metrics
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Time spent in the database, by statement
+QUERY_SECONDS = metrics.REGISTRY.histogram("myanimebot_db_query_seconds", "Duration of the database transactions, waiting for a connection included", ["statement"])
+QUERY_ERRORS  = metrics.REGISTRY.counter("myanimebot_db_errors_total", "Database transactions rolled back", ["statement"])
+
+# Lists of placeholders, the queries built for a variable number of values share the same statement
+PLACEHOLDERS = re.compile(r"\(%s(, %s)*\)(, \(%s(, %s)*\))*")
+
+def get_statement(query):
+	return PLACEHOLDERS.sub("(...)", " ".join(query.split()))
+
+# Asynchronous access to the database.
+# The blocking connector runs in a pool of threads, and each call borrows
+# its own connection from a MariaDB connection pool, so a slow query never
+# stalls the event loop nor the other tasks.
+class AsyncDatabase:
+	def __init__(self, pool_name, pool_size, **conn_params):
+		self.pool     = mariadb.ConnectionPool(pool_name=pool_name, pool_size=pool_size, **conn_params)
+		self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=pool_name)
+
+	# Execute function(cursor, *args) in a single transaction, in a worker thread
+	def _run(self, statement, function, *args):
+		start = time.perf_counter()
+		conn = self.pool.get_connection()
+
+		try:
+			cursor = conn.cursor(buffered=True)
+
+			try:
+				result = function(cursor, *args)
+				conn.commit()
+
+				return result
+			except:
+				conn.rollback()
+				QUERY_ERRORS.inc(statement=statement)
+				raise
+			finally:
+				cursor.close()
+		finally:
+			# Give the connection back to the pool
+			conn.close()
+			QUERY_SECONDS.observe(time.perf_counter() - start, statement=statement)
+
+	async def _submit(self, statement, function, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.executor, self._run, statement, function, *args)
+
+	# The transactions are identified by the name of their function in the metrics
+	async def run(self, function, *args):
+		return await self._submit(function.__name__, function, *args)
+
+	async def fetchone(self, query, params=()):
+		def _fetchone(cursor):
+			cursor.execute(query, params)
+			return cursor.fetchone()
+
+		return await self._submit(get_statement(query), _fetchone)
+
+	async def fetchall(self, query, params=()):
+		def _fetchall(cursor):
+			cursor.execute(query, params)
+			return cursor.fetchall()
+
+		return await self._submit(get_statement(query), _fetchall)
+
+	# Execute a writing query and return the number of affected rows
+	async def execute(self, query, params=()):
+		def _execute(cursor):
+			cursor.execute(query, params)
+			return cursor.rowcount
+
+		return await self._submit(get_statement(query), _execute)
+
+	async def executemany(self, query, seq_params):
+		def _executemany(cursor):
+			cursor.executemany(query, seq_params)
+			return cursor.rowcount
+
+		return await self._submit(get_statement(query), _executemany)
+
+	# Call a stored procedure and return its result set
+	async def callproc(self, name, params=()):
+		def _callproc(cursor):
+			cursor.callproc(name, params)
+			return cursor.fetchall()
+
+		return await self._submit("CALL " + name, _callproc)
+
+	def close(self):
+		self.executor.shutdown(wait=True)
+		self.pool.close()
@@ -0,0 +1,113 @@
+import logging
+import queue
+import socket
+import threading
+import time
+
+from datetime import datetime
+
+# Logging handler that puts the logs into the database.
+# The records are queued in memory and written by a background thread with
+# multi-row inserts, once batch_size records are waiting or flush_interval
+# seconds after the first one. When the queue is full, the records below
+# ERROR are dropped, the others wait up to block_timeout seconds for a slot.
+class LogDBHandler(logging.Handler):
+	def __init__(self, connect, batch_size=100, flush_interval=2.0, queue_size=10000, block_timeout=1.0):
+		logging.Handler.__init__(self)
+
+		# Function returning a new connection, only used by the writer thread
+		self.connect        = connect
+		self.batch_size     = max(1, batch_size)
+		self.flush_interval = flush_interval
+		self.block_timeout  = block_timeout
+		self.queue          = queue.Queue(maxsize=queue_size)
+		self.hostname       = str(socket.gethostname())
+		self.dropped        = 0
+		self.closed         = False
+
+		self.thread = threading.Thread(target=self._writer, name="LogDBHandler", daemon=True)
+		self.thread.start()
+
+	def emit(self, record):
+		# Clear the log message so it can be put to db via sql (escape quotes)
+		log_msg = str(record.getMessage().strip().replace('\'', '\'\''))
+		row = (self.hostname, str(record.levelno), str(record.levelname), log_msg, datetime.fromtimestamp(record.created), str(record.name))
+
+		try:
+			if record.levelno >= logging.ERROR: self.queue.put(row, timeout=self.block_timeout)
+			else: self.queue.put_nowait(row)
+		except queue.Full:
+			self.dropped += 1
+
+	# Wait for the next records to write, None once the handler is closed and the queue empty
+	def _next_batch(self):
+		batch    = []
+		deadline = None
+
+		while len(batch) < self.batch_size:
+			timeout = self.flush_interval if deadline is None else deadline - time.monotonic()
+			if timeout <= 0: break
+
+			try:
+				row = self.queue.get(timeout=timeout)
+			except queue.Empty:
+				break
+
+			# Sentinel sent by close()
+			if row is None:
+				if len(batch) == 0: return None
+
+				self.queue.put(None)
+				break
+
+			batch.append(row)
+			if deadline is None: deadline = time.monotonic() + self.flush_interval
+
+		return batch
+
+	def _write(self, conn, batch):
+		if self.dropped > 0:
+			dropped, self.dropped = self.dropped, 0
+			batch.append((self.hostname, str(logging.WARNING), "WARNING", str(dropped) + " log records dropped, the database is too slow", datetime.now(), "LogDBHandler"))
+
+		cursor = conn.cursor()
+		cursor.execute("INSERT INTO t_logs (host, level, type, log, date, source) VALUES " + ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch)), [value for row in batch for value in row])
+		conn.commit()
+		cursor.close()
+
+	def _writer(self):
+		conn = None
+
+		while True:
+			batch = self._next_batch()
+
+			if batch is None: break
+			if len(batch) == 0: continue
+
+			try:
+				if conn is None: conn = self.connect()
+				self._write(conn, batch)
+			except Exception as e:
+				print ('Error while logging into DB: ' + str(e))
+
+				# The connection is opened again for the next batch
+				try:
+					if conn is not None: conn.close()
+				except Exception:
+					pass
+				conn = None
+
+		if conn is not None: conn.close()
+
+	# Write the remaining records and stop the writer thread
+	def close(self, timeout=10):
+		if not self.closed:
+			self.closed = True
+
+			try:
+				self.queue.put(None, timeout=timeout)
+				self.thread.join(timeout)
+			except queue.Full:
+				print ('Error while logging into DB: unable to flush the remaining logs')
+
+		logging.Handler.close(self)
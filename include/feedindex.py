@@ -0,0 +1,25 @@
+import hashlib
+
+# Index of the feed items already announced, kept in memory so the feeds can
+# be checked without querying t_feeds for each item.
+# The publication dates are strings formatted like in the database
+# ("%Y-%m-%d %H:%M:%S"), so they can be compared to each other directly.
+class FeedIndex:
+	def __init__(self):
+		self.items = set()
+
+	def __len__(self):
+		return len(self.items)
+
+	def _key(self, user, published, title):
+		return (user.lower(), published, hashlib.sha1(title.encode("utf-8")).digest())
+
+	def contains(self, user, published, title):
+		return self._key(user, published, title) in self.items
+
+	def add(self, user, published, title):
+		self.items.add(self._key(user, published, title))
+
+	# Forget the items published before the given date
+	def prune(self, oldest):
+		self.items = { key for key in self.items if key[1] >= oldest }
@@ -0,0 +1,83 @@
+import feedparser
+
+from datetime import datetime, timedelta, timezone
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+# Elements of an item used by the bot
+ITEM_FIELDS = ("title", "link", "guid", "description", "pubDate")
+
+# Month names of the RFC 822 dates
+MONTHS = { "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6, "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12 }
+
+# Maximum number of dates kept by a DateParser
+DATE_CACHE_SIZE = 10000
+
+# An item of a MyAnimeList feed, with the same attributes as the entries of feedparser
+class FeedItem:
+	__slots__ = ("title", "link", "guid", "description", "published")
+
+	def __init__(self, title, link, guid, description, published):
+		self.title       = title
+		self.link        = link
+		self.guid        = guid
+		self.description = description
+		self.published   = published
+
+# Parse the feeds of MyAnimeList (rss.php), only keeping what the bot uses.
+# Anything unexpected in the feed is handed over to feedparser.
+def parse(data):
+	try:
+		return _parse(data)
+	except (ParseError, KeyError, ValueError):
+		return [FeedItem(entry.get("title", ""), entry.get("link", ""), entry.get("id", entry.get("link", "")), entry.get("description", ""), entry.get("published", "")) for entry in feedparser.parse(data).entries]
+
+def _parse(data):
+	parser = XMLPullParser(events=("start", "end"))
+	parser.feed(data)
+	parser.close()
+
+	items = []
+	fields = {}
+
+	# The elements of the channel have the same names, only the ones inside an item are kept
+	for event, element in parser.read_events():
+		if event == "start":
+			if element.tag == "item": fields = {}
+		elif element.tag == "item":
+			items.append(FeedItem(fields["title"], fields["link"], fields.get("guid", fields["link"]), fields.get("description", ""), fields["pubDate"]))
+			element.clear()
+		elif element.tag in ITEM_FIELDS:
+			fields[element.tag] = (element.text or "").strip()
+
+	return items
+
+# Convert the publication dates into the timezone of the bot.
+# The same dates come back at each check of a feed, they are only parsed once.
+class DateParser:
+	def __init__(self, tz):
+		self.tz    = tz
+		self.cache = {}
+
+	# Return the date in the timezone of the bot, and formatted like in the database
+	def parse(self, value):
+		date = self.cache.get(value)
+
+		if date is None:
+			local = self._parse(value).astimezone(self.tz)
+			date = (local, local.strftime("%Y-%m-%d %H:%M:%S"))
+
+			if len(self.cache) >= DATE_CACHE_SIZE: self.cache.clear()
+			self.cache[value] = date
+
+		return date
+
+	# "Sat, 10 Oct 2020 15:30:12 -0700", strptime is only used for the other formats
+	def _parse(self, value):
+		try:
+			day, month, year, clock, offset = value.split(" ")[1:]
+			hour, minute, second = clock.split(":")
+			delta = timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+
+			return datetime(int(year), MONTHS[month], int(day), int(hour), int(minute), int(second), tzinfo=timezone(-delta if offset[0] == "-" else delta))
+		except (ValueError, KeyError, IndexError):
+			return datetime.strptime(value, '%a, %d %b %Y %H:%M:%S %z')
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names, values, extra=()):
+	pairs = [name + "=\"" + _escape(value) + "\"" for name, value in list(zip(names, values)) + list(extra)]
+
+	if len(pairs) == 0: return ""
+	return "{" + ",".join(pairs) + "}"
+
+# Base of the metrics: one value (or set of values) by combination of labels.
+# The metrics are updated from the event loop and from the threads of the database.
+class Metric:
+	kind = "untyped"
+
+	def __init__(self, name, documentation, labels=()):
+		self.name          = name
+		self.documentation = documentation
+		self.labels        = tuple(labels)
+		self.values        = {}
+		self.lock          = threading.Lock()
+
+	def _key(self, labels):
+		return tuple(str(labels.get(name, "")) for name in self.labels)
+
+	def _samples(self):
+		with self.lock:
+			return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+	def render(self):
+		lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.kind]
+		lines += [name + labels + " " + repr(float(value)) for name, labels, value in self._samples()]
+
+		return "\n".join(lines)
+
+class Counter(Metric):
+	kind = "counter"
+
+	def inc(self, value=1, **labels):
+		key = self._key(labels)
+
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+	kind = "gauge"
+
+	def __init__(self, name, documentation, labels=(), function=None):
+		Metric.__init__(self, name, documentation, labels)
+		self.function = function
+
+	def set(self, value, **labels):
+		with self.lock:
+			self.values[self._key(labels)] = value
+
+	def _samples(self):
+		# Read when the metrics are collected
+		if self.function is not None: self.set(self.function())
+		return Metric._samples(self)
+
+class Histogram(Metric):
+	kind = "histogram"
+
+	def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, name, documentation, labels)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, value, **labels):
+		key = self._key(labels)
+
+		with self.lock:
+			counts = self.values.get(key)
+
+			if counts is None:
+				# One count per bucket, then the sum and the total count
+				counts = [0] * len(self.buckets) + [0, 0]
+				self.values[key] = counts
+
+			for i, bucket in enumerate(self.buckets):
+				if value <= bucket: counts[i] += 1
+
+			counts[-2] += value
+			counts[-1] += 1
+
+	# Measure the duration of a block of code
+	@contextmanager
+	def time(self, **labels):
+		start = time.perf_counter()
+
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, **labels)
+
+	def _samples(self):
+		samples = []
+
+		with self.lock:
+			for key, counts in sorted(self.values.items()):
+				for bucket, count in zip(self.buckets, counts):
+					samples.append((self.name + "_bucket", _format_labels(self.labels, key, [("le", repr(float(bucket)))]), count))
+
+				samples.append((self.name + "_bucket", _format_labels(self.labels, key, [("le", "+Inf")]), counts[-1]))
+				samples.append((self.name + "_sum", _format_labels(self.labels, key), counts[-2]))
+				samples.append((self.name + "_count", _format_labels(self.labels, key), counts[-1]))
+
+		return samples
+
+# Set of metrics, rendered in the text format of Prometheus
+class Registry:
+	def __init__(self):
+		self.metrics = []
+
+	def _register(self, metric):
+		self.metrics.append(metric)
+		return metric
+
+	def counter(self, name, documentation, labels=()):
+		return self._register(Counter(name, documentation, labels))
+
+	def gauge(self, name, documentation, labels=(), function=None):
+		return self._register(Gauge(name, documentation, labels, function))
+
+	def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+		return self._register(Histogram(name, documentation, labels, buckets))
+
+	def render(self):
+		return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+	# For the scripts not running long enough to be scraped (textfile collector of node_exporter)
+	def write(self, path):
+		temp_path = path + ".tmp"
+
+		with open(temp_path, "w") as metrics_file:
+			metrics_file.write(self.render())
+
+		os.replace(temp_path, path)
+
+# Metrics of the running script
+REGISTRY = Registry()
@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+# Token bucket shared by every coroutine requesting the same website.
+# It also works as a circuit breaker: the requests are paused, longer at each
+# failure in a row, while the website is throttling us or down.
+class RateLimiter:
+	def __init__(self, rate, burst=1, max_backoff=600):
+		# A rate of 0 (or less) disable the limitation
+		self.rate    = rate
+		self.burst   = max(1, burst)
+		self.tokens  = self.burst
+		self.updated = time.monotonic()
+		self.lock    = None
+
+		self.max_backoff  = max_backoff
+		self.failures     = 0
+		self.paused_until = 0
+
+	def _refill(self):
+		now = time.monotonic()
+		self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def paused(self):
+		return time.monotonic() < self.paused_until
+
+	# Learn from the status of a response, 0 for a network error.
+	# Return the pause started (in seconds), 0 if the website answered normally.
+	def report(self, status, retry_after=None):
+		if status != 0 and status != 429 and status < 500:
+			self.failures = 0
+			return 0
+
+		self.failures += 1
+
+		delay = min(self.max_backoff, 2 ** (self.failures - 1))
+		if retry_after is not None: delay = max(delay, retry_after)
+
+		self.paused_until = max(self.paused_until, time.monotonic() + delay)
+		return delay
+
+	# Wait until a request can be sent
+	async def acquire(self):
+		while self.paused():
+			await asyncio.sleep(self.paused_until - time.monotonic())
+
+		if self.rate <= 0: return
+
+		# The lock is created here so it belongs to the running event loop
+		if self.lock is None: self.lock = asyncio.Lock()
+
+		async with self.lock:
+			self._refill()
+
+			while self.tokens < 1:
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+				self._refill()
+
+			self.tokens -= 1
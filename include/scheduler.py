@@ -0,0 +1,62 @@
+import heapq
+import time
+
+# Schedule the checks of the users' feeds, each user having his own interval.
+# The interval goes back to min_interval when something new is found in the feeds
+# of a user, and grows by backoff at each check finding nothing, up to max_interval.
+class PollScheduler:
+	def __init__(self, min_interval, max_interval, backoff=1.5):
+		self.min_interval = min_interval
+		self.max_interval = max(min_interval, max_interval)
+		self.backoff      = backoff
+
+		# (next check, user), the entries not matching self.users are outdated
+		self.heap  = []
+
+		# user -> [interval, next check], the next check being None while the user is checked
+		self.users = {}
+
+	def __len__(self):
+		return len(self.users)
+
+	def __contains__(self, user):
+		return user in self.users
+
+	def _push(self, user, interval, delay):
+		due = time.monotonic() + delay
+
+		self.users[user] = [interval, due]
+		heapq.heappush(self.heap, (due, user))
+
+	# Add a user, checked after the given delay
+	def add(self, user, interval, delay=0):
+		self._push(user, min(max(interval, self.min_interval), self.max_interval), delay)
+
+	def remove(self, user):
+		self.users.pop(user, None)
+
+	# Remove and return the users who must be checked now, with the time they were due
+	def pop_due(self):
+		now = time.monotonic()
+		due = []
+
+		while len(self.heap) > 0 and self.heap[0][0] <= now:
+			when, user = heapq.heappop(self.heap)
+			state = self.users.get(user)
+
+			if state is None or state[1] != when: continue
+
+			state[1] = None
+			due.append((user, when))
+
+		return due
+
+	# Schedule the next check of a user, according to what was found in his feeds
+	def reschedule(self, user, active):
+		state = self.users.get(user)
+		if state is None: return
+
+		if active: interval = self.min_interval
+		else: interval = min(state[0] * self.backoff, self.max_interval)
+
+		self._push(user, interval, interval)
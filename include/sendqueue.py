@@ -0,0 +1,119 @@
+import asyncio
+import inspect
+
+import aiohttp
+import discord
+
+import metrics
+
+SEND_SECONDS = metrics.REGISTRY.histogram("myanimebot_discord_send_seconds", "Duration of the messages sent to Discord, retries included")
+MESSAGES     = metrics.REGISTRY.counter("myanimebot_discord_messages_total", "Messages sent to Discord, by result", ["result"])
+EMBEDS       = metrics.REGISTRY.counter("myanimebot_discord_embeds_total", "Embeds sent to Discord")
+
+# Messages waiting to be sent, by channel. Each channel has its own task, so a slow
+# or rate limited channel doesn't delay the others, nor the checks of the feeds.
+# When the Discord library can send several embeds in one message, the embeds waiting
+# for the same channel are grouped together.
+class SendQueue:
+	def __init__(self, client, logger, retries=3, max_embeds=10):
+		self.client  = client
+		self.logger  = logger
+		self.retries = retries
+
+		self.queues   = {}
+		self.tasks    = {}
+		self.channels = {}
+
+		# Only the recent versions of discord.py accept a list of embeds
+		self.max_embeds = max_embeds if "embeds" in inspect.signature(discord.abc.Messageable.send).parameters else 1
+
+	def __len__(self):
+		return sum(len(queue) for queue in self.queues.values())
+
+	# Queue an embed for a channel, with the path of the thumbnail to attach if there is one,
+	# and the URL used instead if the file has been removed meanwhile
+	def put(self, channelid, embed, thumbnail=None, image=None):
+		self.queues.setdefault(channelid, []).append((embed, thumbnail, image))
+
+		if channelid not in self.tasks: self.tasks[channelid] = asyncio.ensure_future(self._run(channelid))
+
+	async def _run(self, channelid):
+		try:
+			queue = self.queues[channelid]
+
+			while len(queue) > 0:
+				batch = queue[:self.max_embeds]
+				del queue[:len(batch)]
+
+				with SEND_SECONDS.time():
+					await self._send(channelid, batch)
+		finally:
+			del self.queues[channelid]
+			del self.tasks[channelid]
+
+	def _message(self, batch):
+		files = {}
+
+		for embed, thumbnail, image in batch:
+			if thumbnail is None: continue
+
+			if thumbnail not in files:
+				try:
+					files[thumbnail] = discord.File(thumbnail)
+				except OSError:
+					# Removed from the store while the message was waiting
+					files[thumbnail] = None
+
+			if files[thumbnail] is None: embed.set_thumbnail(url=image)
+
+		files = [file for file in files.values() if file is not None]
+
+		if self.max_embeds == 1: message = { "embed": batch[0][0] }
+		else: message = { "embeds": [embed for embed, thumbnail, image in batch] }
+
+		if len(files) == 1: message["file"] = files[0]
+		elif len(files) > 1: message["files"] = files
+
+		return message
+
+	# Without the gateway, the channels are not cached by the client and have to be requested
+	async def _channel(self, channelid):
+		channel = self.client.get_channel(int(channelid)) or self.channels.get(channelid)
+
+		if channel is None:
+			channel = await self.client.fetch_channel(int(channelid))
+			self.channels[channelid] = channel
+
+		return channel
+
+	async def _send(self, channelid, batch):
+		try:
+			channel = await self._channel(channelid)
+		except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+			self.logger.debug("Impossible to send a message on '" + channelid + "': " + str(e))
+			MESSAGES.inc(result="dropped")
+			return
+
+		for attempt in range(self.retries + 1):
+			try:
+				await channel.send(**self._message(batch))
+				self.logger.info("Message sent in channel: " + channelid)
+
+				MESSAGES.inc(result="sent")
+				EMBEDS.inc(len(batch))
+				return
+			except discord.HTTPException as e:
+				# Missing permissions, deleted channel... no need to try again
+				if e.status < 500 and e.status != 429:
+					self.logger.debug("Impossible to send a message on '" + channelid + "': " + str(e))
+					MESSAGES.inc(result="dropped")
+					return
+
+				error = e
+			except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+				error = e
+
+			if attempt < self.retries: await asyncio.sleep(2 ** attempt)
+
+		self.logger.warning("Impossible to send a message on '" + channelid + "' after " + str(self.retries + 1) + " attempts: " + str(error))
+		MESSAGES.inc(result="failed")
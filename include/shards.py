@@ -0,0 +1,10 @@
+import hashlib
+
+# Split the users between the running instances of the bot with rendezvous hashing:
+# each user belongs to the instance with the highest score for him. When an instance
+# starts or stops, only the users it gains or loses are moved.
+def score(worker, user):
+	return hashlib.md5((worker + "\n" + user.lower()).encode("utf-8")).digest()
+
+def owner(user, workers):
+	return max(workers, key=lambda worker: score(worker, user))
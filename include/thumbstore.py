@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import io
+import re
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+# Pillow is optional, without it the images are stored as downloaded
+try:
+	from PIL import Image
+except ImportError:
+	Image = None
+
+# Extensions of the image formats used by MyAnimeList, from their magic numbers
+IMAGE_TYPES = (
+	(b"\xff\xd8\xff", ".jpg"),
+	(b"\x89PNG", ".png"),
+	(b"GIF8", ".gif"),
+	(b"RIFF", ".webp")
+)
+
+# Names of the stored images, only those are removed from the directory
+HASHED_NAME = re.compile(r"^[0-9a-f]{64}\.[a-z]+$")
+
+# On-disk store of the thumbnails, so the embeds don't depend on the CDN of MyAnimeList.
+# The files are named after the hash of the downloaded image, the same image used by
+# several medias is stored once. The least recently used files are removed once the
+# store is bigger than max_size bytes. The index is written at most once every
+# save_interval seconds, and when the store is closed.
+class ThumbnailStore:
+	def __init__(self, path, max_size, max_dimension=225, save_interval=60):
+		self.path          = path
+		self.index_path    = os.path.join(path, "index.json")
+		self.max_size      = max_size
+		self.max_dimension = max_dimension
+		self.save_interval = save_interval
+		self.lock          = threading.Lock()
+
+		# guid -> file name, and file name -> size ordered from the least recently used
+		self.guids = {}
+		self.files = OrderedDict()
+		self.size  = 0
+
+		# hash -> file name, and file name -> guids using it
+		self.digests = {}
+		self.medias  = {}
+
+		self.dirty     = False
+		self.last_save = time.monotonic()
+
+		os.makedirs(path, exist_ok=True)
+		self.load()
+
+	def load(self):
+		if os.path.isfile(self.index_path):
+			with open(self.index_path, "r") as index_file:
+				index = json.load(index_file)
+
+			for name, size in index["files"]:
+				if os.path.isfile(os.path.join(self.path, name)):
+					self.files[name] = size
+					self.size += size
+					self.digests[os.path.splitext(name)[0]] = name
+
+			for guid, name in index["guids"].items():
+				if name in self.files: self._link(guid, name)
+
+		# Stored after the last save of the index (the bot was killed), they would never be removed
+		for name in os.listdir(self.path):
+			if name not in self.files and HASHED_NAME.match(name):
+				try:
+					os.remove(os.path.join(self.path, name))
+				except OSError:
+					pass
+
+	def _save(self):
+		temp_path = self.index_path + ".tmp"
+
+		with open(temp_path, "w") as index_file:
+			json.dump({ "guids": self.guids, "files": list(self.files.items()) }, index_file)
+
+		os.replace(temp_path, self.index_path)
+
+		self.dirty     = False
+		self.last_save = time.monotonic()
+
+	# Write the index if it changed, blocking
+	def close(self):
+		with self.lock:
+			if self.dirty: self._save()
+
+	def _link(self, guid, name):
+		previous = self.guids.get(guid)
+		if previous is not None and previous != name: self.medias[previous].discard(guid)
+
+		self.guids[guid] = name
+		self.medias.setdefault(name, set()).add(guid)
+
+	def contains(self, guid):
+		return guid in self.guids
+
+	# Path of the thumbnail of a media, None if it isn't stored
+	def get(self, guid):
+		with self.lock:
+			name = self.guids.get(guid)
+			if name is None: return None
+
+			self.files.move_to_end(name)
+			return os.path.join(self.path, name)
+
+	def _resize(self, data):
+		if Image is None: return data, None
+
+		image = Image.open(io.BytesIO(data))
+		image.thumbnail((self.max_dimension, self.max_dimension))
+
+		output = io.BytesIO()
+		image.convert("RGB").save(output, "JPEG", quality=85)
+
+		return output.getvalue(), ".jpg"
+
+	def _extension(self, data):
+		for magic, extension in IMAGE_TYPES:
+			if data.startswith(magic): return extension
+		return ".jpg"
+
+	def _evict(self):
+		while self.size > self.max_size and len(self.files) > 1:
+			name, size = self.files.popitem(last=False)
+			self.size -= size
+
+			try:
+				os.remove(os.path.join(self.path, name))
+			except OSError:
+				pass
+
+			for guid in self.medias.pop(name, ()): del self.guids[guid]
+			del self.digests[os.path.splitext(name)[0]]
+
+	# Write an image into the store, return its file name and content
+	def _write(self, digest, data):
+		content, extension = self._resize(data)
+		name = digest + (extension or self._extension(data))
+
+		with open(os.path.join(self.path, name), "wb") as image_file:
+			image_file.write(content)
+
+		return name, content
+
+	# Store the downloaded thumbnail of a media and return its path. Blocking, run it in an executor.
+	def put(self, guid, data):
+		digest = hashlib.sha256(data).hexdigest()
+
+		with self.lock:
+			name = self.digests.get(digest)
+
+		if name is None: name, content = self._write(digest, data)
+		else: content = None
+
+		with self.lock:
+			if name not in self.files:
+				# Removed since it was found, it's written again
+				if content is None: name, content = self._write(digest, data)
+
+				size = len(content)
+				self.files[name] = size
+				self.size += size
+				self.digests[digest] = name
+
+			self.files.move_to_end(name)
+			self._link(guid, name)
+
+			self._evict()
+
+			self.dirty = True
+			if time.monotonic() - self.last_save >= self.save_interval: self._save()
+
+			return os.path.join(self.path, self.guids[guid]) if guid in self.guids else None
+
+	# Download a thumbnail with an aiohttp session and store it
+	async def fetch(self, session, guid, url):
+		async with session.get(url) as response:
+			response.raise_for_status()
+			data = await response.read()
+
+		return await asyncio.get_running_loop().run_in_executor(None, self.put, guid, data)
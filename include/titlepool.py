@@ -0,0 +1,47 @@
+import random
+
+import utils
+
+# Titles of the medias shown in the bot's activity, kept in memory so a title can be
+# picked without querying t_animes. Each media is weighted by its recent activity,
+# the medias added often to the users' lists are shown more often.
+class TitlePool:
+	def __init__(self):
+		self.positions = {}
+		self.titles    = []
+		self.weights   = []
+
+	def __len__(self):
+		return len(self.titles)
+
+	# Add a media, or update its title if it's already in the pool
+	def add(self, guid, title, weight=1):
+		if title is None: return
+
+		title = utils.truncate_end_show(title)
+		position = self.positions.get(guid)
+
+		if position is None:
+			self.positions[guid] = len(self.titles)
+			self.titles.append(title)
+			self.weights.append(weight)
+		else: self.titles[position] = title
+
+	# Weight all the medias again from their recent activity: guid -> number of times added
+	def reweight(self, activity):
+		weights = [1] * len(self.titles)
+
+		for guid, position in self.positions.items():
+			weights[position] = 1 + activity.get(guid, 0)
+
+		self.weights = weights
+
+	# A media has been added again by a user
+	def bump(self, guid, weight=1):
+		position = self.positions.get(guid)
+		if position is not None: self.weights[position] += weight
+
+	# Pick a title, None if the pool is empty
+	def sample(self):
+		if len(self.titles) == 0: return None
+		return random.choices(self.titles, weights=self.weights)[0]
@@ -1,18 +1,77 @@
-import urllib.request
 import re
+import email.utils
 
-from bs4 import BeautifulSoup
+from datetime import datetime, timezone
 
-# Get thumbnail from an URL
-def getThumbnail(urlParam):
-	url = "/".join((urlParam).split("/")[:5])
+# Size of the chunks read from a media page
+CHUNK_SIZE = 8192
+
+# The tag holding the picture of the media, and the Open Graph image as fallback
+IMAGE_TAG    = re.compile(rb'<img\b[^>]*\bitemprop="image"[^>]*>')
+OG_IMAGE_TAG = re.compile(rb'<meta\b[^>]*\bproperty="og:image"[^>]*>')
+TAG_URL      = re.compile(rb'(?P<url>https?://[^\s"\']+)')
+
+# Get the page of a media from one of its URL
+def getMediaUrl(urlParam):
+	return "/".join((urlParam).split("/")[:5])
+
+# Look for the thumbnail in a page received chunk by chunk, without building a DOM
+class ThumbnailScanner:
+	def __init__(self):
+		self.buffer   = b""
+		self.og_image = None
+	
+	def _url(self, tag):
+		url = TAG_URL.search(tag)
+		
+		if url is None: return None
+		return url.group("url").decode("utf-8", "replace")
+	
+	# Return the thumbnail as soon as its tag is complete, None if more data is needed
+	def feed(self, chunk):
+		self.buffer += chunk
+		
+		if self.og_image is None:
+			tag = OG_IMAGE_TAG.search(self.buffer)
+			if tag is not None: self.og_image = self._url(tag.group(0))
+		
+		tag = IMAGE_TAG.search(self.buffer)
+		if tag is not None: return self._url(tag.group(0))
+		
+		# Only keep what could be the beginning of a truncated tag
+		self.buffer = self.buffer[-CHUNK_SIZE:]
+		return None
+	
+	# End of the page, the Open Graph image is the last chance
+	def close(self):
+		if self.og_image is None: raise ValueError("no thumbnail found in the page")
+		return self.og_image
+
+# Get thumbnail from an URL, using the given aiohttp session.
+# The download stops once the picture of the media has been found.
+async def getThumbnailAsync(session, urlParam):
+	scanner = ThumbnailScanner()
+	
+	async with session.get(getMediaUrl(urlParam)) as websource:
+		websource.raise_for_status()
+		
+		async for chunk in websource.content.iter_chunked(CHUNK_SIZE):
+			thumbnail = scanner.feed(chunk)
+			if thumbnail is not None: return thumbnail
+	
+	return scanner.close()
+
+# Number of seconds asked by a Retry-After header (in seconds or as a date), None if there is none
+def getRetryAfter(headers):
+	value = None if headers is None else headers.get("Retry-After")
 	
-	websource = urllib.request.urlopen(url)
-	soup = BeautifulSoup(websource.read(), "html.parser")
-	image = re.search("(?P<url>https?://[^\s]+)", str(soup.find("img", {"itemprop": "image"}))).group("url")
-	thumbnail = "".join(image.split('"')[:1]).replace('"','')
+	if value is None: return None
+	if value.strip().isdigit(): return int(value)
 	
-	return thumbnail
+	try:
+		return max(0, (email.utils.parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+	except (TypeError, ValueError):
+		return None
 
 # Replace multiple substrings from a string
 def replace_all(text, dic):
@@ -1,35 +1,42 @@
 #!/usr/bin/env python3
 # Copyright Penta (c) 2018/2020 - Under BSD License
 
-# Compatible for Python 3.6.X
+# Compatible for Python 3.7.X
 #
 # Check and update all the thumbnail for manga/anime in the MyAnimeBot database.
 # Can be pretty long and send a lot of request to MyAnimeList.net,
 # Use it only once in a while to clean the database.
 #
+# The progress is saved in t_sys, an interrupted run resumes where it stopped.
+# Use the --restart option to check all the medias again.
+#
 # Dependencies (for CentOS 7):
 # yum install python3 mariadb-devel gcc python3-devel
-# python3.6 -m pip install --upgrade pip
-# pip3.6 install mysql python-dateutil asyncio html2text bs4 aiodns cchardet configparser
-# pip3.6 install mysql.connector
+# python3.7 -m pip install --upgrade pip
+# pip3.7 install mysql python-dateutil asyncio aiohttp html2text aiodns cchardet configparser
+# pip3.7 install mysql.connector
 
 # Library import
 import logging
 import os
+import sys
 import re
 import asyncio
-import urllib.request
+import aiohttp
 import mysql.connector as mariadb
 import string
 import time
 import socket
 
 from html2text import HTML2Text
-from bs4 import BeautifulSoup
 from configparser import ConfigParser
 
 # Custom library
+sys.path.append('include/')
 import utils
+import dblog
+import ratelimit
+import metrics
 
 class ImproperlyConfigured(Exception): pass
 
@@ -71,28 +78,14 @@ dbUser=CONFIG.get("dbUser", "myanimebot")
 dbPassword=CONFIG.get("dbPassword")
 dbName=CONFIG.get("dbName", "myanimebot")
 logPath=CONFIG.get("logPath", "myanimebot.log")
-
-# class that send logs to DB
-class LogDBHandler(logging.Handler):
-	'''
-	Customized logging handler that puts logs to the database.
-	pymssql required
-	'''
-	def __init__(self, sql_conn, sql_cursor):
-		logging.Handler.__init__(self)
-		self.sql_cursor = sql_cursor
-		self.sql_conn   = sql_conn
-
-	def emit(self, record):	
-		# Clear the log message so it can be put to db via sql (escape quotes)
-		self.log_msg = str(record.msg.strip().replace('\'', '\'\''))
-		
-		# Make the SQL insert
-		try:
-			self.sql_cursor.execute("INSERT INTO t_logs (host, level, type, log, date, source) VALUES (%s, %s, %s, %s, NOW(), %s)", (str(socket.gethostname()), str(record.levelno), str(record.levelname), self.log_msg, str(record.name)))
-			self.sql_conn.commit()
-		except Exception as e:
-			print ('Error while logging into DB: ' + str(e))
+logDbBatchSize=CONFIG.getint("logDbBatchSize", 100)
+logDbFlushInterval=CONFIG.getfloat("logDbFlushInterval", 2)
+logDbQueueSize=CONFIG.getint("logDbQueueSize", 10000)
+refresherConcurrency=max(1, CONFIG.getint("refresherConcurrency", 4))
+refresherRequestsPerSecond=CONFIG.getfloat("refresherRequestsPerSecond", 1)
+refresherBatchSize=max(1, CONFIG.getint("refresherBatchSize", 50))
+refresherMetricsFile=CONFIG.get("refresherMetricsFile", "")
+malMaxBackoff=CONFIG.getint("malMaxBackoff", 600)
 
 
 # Log configuration
@@ -109,7 +102,31 @@ logger.setLevel(logLevel)
 logging.getLogger('').addHandler(console)
 
 # Script version
-VERSION = "1.1"
+VERSION = "1.2"
+
+# The http header sent with every request
+HTTP_HEADERS = { "User-Agent": "MyAnimeBot Thumbnail Refresher v" + VERSION, }
+
+# Parameter of t_sys where the last media checked is saved
+CHECKPOINT_PARAM = "thumbnail_refresher_checkpoint"
+
+# Metrics of the run, written into refresherMetricsFile after each batch
+REFRESH_SECONDS = metrics.REGISTRY.histogram("myanimebot_refresher_media_seconds", "Duration of the check of a media")
+MEDIAS          = metrics.REGISTRY.counter("myanimebot_refresher_medias_total", "Medias checked, by result", ["result"])
+HTTP_RESPONSES  = metrics.REGISTRY.counter("myanimebot_refresher_http_responses_total", "HTTP responses of MyAnimeList by status code (0 for a network error)", ["code"])
+SAVE_SECONDS    = metrics.REGISTRY.histogram("myanimebot_refresher_save_seconds", "Duration of the transaction saving a batch")
+CHECKPOINT      = metrics.REGISTRY.gauge("myanimebot_refresher_checkpoint", "Id of the last media checked")
+RUN_SECONDS     = metrics.REGISTRY.gauge("myanimebot_refresher_run_seconds", "Duration of the run so far")
+
+def write_metrics():
+	if refresherMetricsFile == "": return
+	
+	RUN_SECONDS.set(time.time() - startTime)
+	
+	try:
+		metrics.REGISTRY.write(refresherMetricsFile)
+	except Exception as e:
+		logger.warning("Unable to write the metrics: " + str(e))
 
 logger.info("Booting the MyAnimeBot Thumbnail Refresher " + VERSION + "...")
 
@@ -117,66 +134,122 @@ logger.info("Booting the MyAnimeBot Thumbnail Refresher " + VERSION + "...")
 try:
 	conn = mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName, buffered=True)
 	
-	# We initialize the logs into the DB.
-	log_conn   = mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName, buffered=True)
-	log_cursor = log_conn.cursor()
-	logdb = LogDBHandler(log_conn, log_cursor)
+	# We initialize the logs into the DB, written in batches by their own thread and connection.
+	logdb = dblog.LogDBHandler(lambda: mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName, buffered=True), logDbBatchSize, logDbFlushInterval, logDbQueueSize)
 	logging.getLogger('').addHandler(logdb)
 except Exception as e :
 	logger.critical("Can't connect to the database: " + str(e))
 	
-	httpclient.close()
 	quit()
 
-def main() :
-	logger.info("Starting the refresher task...")
-	
-	count = 0
+# Get the id of the last media checked by an interrupted run
+def get_checkpoint(cursor):
+	cursor.execute("SELECT value FROM t_sys WHERE param = %s", [CHECKPOINT_PARAM])
+	data = cursor.fetchone()
 	
+	if data is None: return 0
+	return int(data[0])
+
+# Write the new thumbnails and the progress in a single transaction
+def save_batch(updates, checkpoint):
+	with SAVE_SECONDS.time():
+		_save_batch(updates, checkpoint)
+
+def _save_batch(updates, checkpoint):
 	cursor = conn.cursor(buffered=True)
-	cursor.execute("SELECT guid, title, thumbnail FROM t_animes")
-	datas = cursor.fetchall()
 	
-	logger.info(str(len(datas)) + " medias are going to be checked.")
+	if len(updates) > 0: cursor.executemany("UPDATE t_animes SET thumbnail = %s WHERE guid = %s", updates)
+	
+	if checkpoint is None: cursor.execute("DELETE FROM t_sys WHERE param = %s", [CHECKPOINT_PARAM])
+	else: cursor.execute("INSERT INTO t_sys (param, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value = VALUES(value)", [CHECKPOINT_PARAM, str(checkpoint)])
+	
+	conn.commit()
+	cursor.close()
+
+# Let the limiter know how MyAnimeList answered, the requests are paused while it's throttling us or down
+def report_status(limiter, status, headers=None):
+	failures = limiter.failures
+	delay = limiter.report(status, utils.getRetryAfter(headers))
+	
+	HTTP_RESPONSES.inc(code=status)
+	
+	if delay > 0 and failures == 0: logger.warning("MyAnimeList answered with the code " + str(status) + ", the requests are paused for " + str(round(delay)) + "s")
+	elif delay > 0: logger.debug("MyAnimeList still unavailable (" + str(status) + "), the requests are paused for " + str(round(delay)) + "s")
+	elif failures > 0: logger.info("MyAnimeList is available again")
 
-	for data in datas:
+async def refresh_thumbnail(session, limiter, semaphore, data, updates):
+	async with semaphore:
+		await limiter.acquire()
+		
+		start = time.perf_counter()
+		
 		try:
-			image = utils.getThumbnail(data[0])
+			image = await utils.getThumbnailAsync(session, data[1])
+			report_status(limiter, 200)
 			
-			if (image == data[2]) :
-				if (image != "") :
-					logger.debug("Thumbnail for " + str(data[1]) + " already up to date.")
-				else :
-					logger.info("Thumbnail for " + str(data[1]) + " still empty.")
+			if (image == data[3]) :
+				logger.debug("Thumbnail for " + str(data[2]) + " already up to date.")
+				MEDIAS.inc(result="unchanged")
 			else :
-				if (image != "") :
-					cursor.execute("UPDATE t_animes SET thumbnail = %s WHERE guid = %s", [image, data[0]])
-					conn.commit()
-					
-					logger.info("Updated thumbnail found for \"" + str(data[1]) + "\": %s", image)
-					count += 1
-				else :
-					try :
-						urllib.request.urlopen(data[2])
-						logger.info("Thumbnail for \"" + str(data[1]) + "\" is now empty, avoiding change.")
-					except :
-						logger.info("Thumbnail for \"" + str(data[1]) + "\" has been deleted!")
+				updates.append([image, data[1]])
+				logger.info("Updated thumbnail found for \"" + str(data[2]) + "\": %s", image)
+				MEDIAS.inc(result="updated")
 		except Exception as e :
-			logger.warning("Error while updating thumbnail for '" + str(data[1]) + "': " + str(e))
+			if isinstance(e, aiohttp.ClientResponseError): report_status(limiter, e.status, e.headers)
+			elif isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)): report_status(limiter, 0)
+			
+			logger.warning("Error while updating thumbnail for '" + str(data[2]) + "': " + str(e))
+			MEDIAS.inc(result="error")
+		finally:
+			REFRESH_SECONDS.observe(time.perf_counter() - start)
 
-		time.sleep(3)
+async def main() :
+	logger.info("Starting the refresher task...")
 	
-	logger.info("All thumbnails checked!")
+	count = 0
+	loop = asyncio.get_running_loop()
+	
+	cursor = conn.cursor(buffered=True)
+	checkpoint = 0 if "--restart" in sys.argv else get_checkpoint(cursor)
+	cursor.execute("SELECT id, guid, title, thumbnail FROM t_animes WHERE id > %s ORDER BY id", [checkpoint])
+	datas = cursor.fetchall()
 	cursor.close()
 	
+	if checkpoint > 0: logger.info("Resuming the previous run after the media #" + str(checkpoint) + ".")
+	logger.info(str(len(datas)) + " medias are going to be checked.")
+	
+	limiter = ratelimit.RateLimiter(refresherRequestsPerSecond, max_backoff=malMaxBackoff)
+	semaphore = asyncio.Semaphore(refresherConcurrency)
+	
+	async with aiohttp.ClientSession(headers=HTTP_HEADERS, connector=aiohttp.TCPConnector(limit=refresherConcurrency)) as session:
+		for i in range(0, len(datas), refresherBatchSize):
+			batch = datas[i:i + refresherBatchSize]
+			updates = []
+			
+			await asyncio.gather(*[refresh_thumbnail(session, limiter, semaphore, data, updates) for data in batch])
+			
+			# The whole batch has been checked, it won't be checked again if the script is interrupted
+			await loop.run_in_executor(None, save_batch, updates, batch[-1][0])
+			count += len(updates)
+			
+			CHECKPOINT.set(batch[-1][0])
+			write_metrics()
+	
+	# Next run will check everything again
+	save_batch([], None)
+	write_metrics()
+	
+	logger.info("All thumbnails checked!")
+	
 	logger.info(str(count) + " new thumbnails, time taken: %ss" % round((time.time() - startTime), 2))
 
 # Starting main function
 if __name__ == "__main__" :
 	startTime = time.time()
-	main()
+	asyncio.run(main())
 
 	logger.info("Thumbnail refresher script stopped")
 	
 	# We close all the ressources
 	conn.close()
+	logdb.close()
@@ -7,7 +7,8 @@
 # curl -LsS https://downloads.mariadb.com/MariaDB/mariadb_repo_setup | sudo bash
 # yum install gcc MariaDB-client MariaDB-common MariaDB-shared MariaDB-devel
 # python3.7 -m pip install --upgrade pip
-# pip3.7 install discord.py mariadb pytz feedparser python-dateutil asyncio html2text bs4 PyNaCL aiodns cchardet configparser
+# pip3.7 install discord.py mariadb pytz feedparser python-dateutil asyncio html2text PyNaCL aiodns cchardet configparser
+# pip3.7 install Pillow (optional, to resize the stored thumbnails)
 
 # Library import
 import logging
@@ -18,20 +19,32 @@ import feedparser
 import pytz
 import aiohttp
 import asyncio
-import urllib.request
 import mariadb
 import string
 import time
 import socket
+import email.utils
 
 # Custom libraries
 sys.path.append('include/')
 import utils
+import ratelimit
+import database
+import feedindex
+import dblog
+import thumbstore
+import titlepool
+import malrss
+import scheduler
+import sendqueue
+import shards
+import metrics
 
 from configparser import ConfigParser
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil.parser import parse as parse_datetime
 from html2text import HTML2Text
+from aiohttp import web
 from aiohttp.web_exceptions import HTTPError, HTTPNotModified
 
 if not sys.version_info[:2] >= (3, 7):
@@ -78,31 +91,46 @@ dbHost=CONFIG.get("dbHost", "127.0.0.1")
 dbUser=CONFIG.get("dbUser", "myanimebot")
 dbPassword=CONFIG.get("dbPassword")
 dbName=CONFIG.get("dbName", "myanimebot")
+dbPoolSize=CONFIG.getint("dbPoolSize", 5)
 logPath=CONFIG.get("logPath", "myanimebot.log")
 timezone=pytz.timezone(CONFIG.get("timezone", "utc"))
 secondMax=CONFIG.getint("secondMax", 7200)
 token=CONFIG.get("token")
 prefix=CONFIG.get("prefix", "!malbot")
+malUrl=CONFIG.get("malUrl", "https://myanimelist.net").rstrip("/")
 iconMAL=CONFIG.get("iconMAL", "https://cdn.myanimelist.net/img/sp/icon/apple-touch-icon-256.png")
 iconBot=CONFIG.get("iconBot", "http://myanimebot.pentou.eu/rsc/bot_avatar.jpg")
+maxConcurrentUsers=max(1, CONFIG.getint("maxConcurrentUsers", 4))
+requestsPerSecond=CONFIG.getfloat("requestsPerSecond", 2)
+httpMaxConnections=CONFIG.getint("httpMaxConnections", 100)
+httpMaxConnectionsPerHost=CONFIG.getint("httpMaxConnectionsPerHost", 10)
+httpDnsCacheTTL=CONFIG.getint("httpDnsCacheTTL", 300)
+thumbnailCheckInterval=CONFIG.getint("thumbnailCheckInterval", 43200)
+thumbnailMaxAge=CONFIG.getint("thumbnailMaxAge", 604800)
+thumbnailConcurrency=max(1, CONFIG.getint("thumbnailConcurrency", 4))
+thumbnailRequestsPerSecond=CONFIG.getfloat("thumbnailRequestsPerSecond", 2)
+malMaxBackoff=CONFIG.getint("malMaxBackoff", 600)
+availabilityInterval=CONFIG.getint("availabilityInterval", 60)
+metricsHost=CONFIG.get("metricsHost", "127.0.0.1")
+metricsPort=CONFIG.getint("metricsPort", 0)
+sharding=CONFIG.getboolean("sharding", False)
+workerId=CONFIG.get("workerId", "") or socket.gethostname()
+workerTimeout=CONFIG.getint("workerTimeout", 180)
+discordGateway=CONFIG.getboolean("discordGateway", True)
+pollMinInterval=max(1, CONFIG.getint("pollMinInterval", 60))
+pollMaxInterval=CONFIG.getint("pollMaxInterval", 3600)
+pollActivityDays=max(1, CONFIG.getint("pollActivityDays", 30))
+topCacheTTL=CONFIG.getint("topCacheTTL", 300)
+profileCacheTTL=CONFIG.getint("profileCacheTTL", 86400)
+profileNotFoundTTL=CONFIG.getint("profileNotFoundTTL", 600)
+titlePoolActivityDays=CONFIG.getint("titlePoolActivityDays", 30)
+thumbnailStorePath=CONFIG.get("thumbnailStorePath", "")
+thumbnailStoreMaxSize=CONFIG.getint("thumbnailStoreMaxSize", 200)
+thumbnailStoreMaxDimension=CONFIG.getint("thumbnailStoreMaxDimension", 225)
 
-# class that send logs to DB
-class LogDBHandler(logging.Handler):
-	def __init__(self, sql_conn, sql_cursor):
-		logging.Handler.__init__(self)
-		self.sql_cursor = sql_cursor
-		self.sql_conn   = sql_conn
-
-	def emit(self, record):	
-		# Clear the log message so it can be put to db via sql (escape quotes)
-		self.log_msg = str(record.msg.strip().replace('\'', '\'\''))
-		
-		# Make the SQL insert
-		try:
-			self.sql_cursor.execute("INSERT INTO t_logs (host, level, type, log, date, source) VALUES (%s, %s, %s, %s, NOW(), %s)", (str(socket.gethostname()), str(record.levelno), str(record.levelname), self.log_msg, str(record.name)))
-			self.sql_conn.commit()
-		except Exception as e:
-			print ('Error while logging into DB: ' + str(e))
+logDbBatchSize=CONFIG.getint("logDbBatchSize", 100)
+logDbFlushInterval=CONFIG.getfloat("logDbFlushInterval", 2)
+logDbQueueSize=CONFIG.getint("logDbQueueSize", 10000)
 
 # Log configuration
 log_format='%(asctime)-13s : %(name)-15s : %(levelname)-8s : %(message)s'
@@ -120,6 +148,9 @@ logging.getLogger('').addHandler(console)
 # Script version
 VERSION = "0.9.6.2"
 
+# The http header sent with every request
+HTTP_HEADERS = { "User-Agent": "MyAnimeBot Discord Bot v" + VERSION, }
+
 # The help message
 HELP = 	"""**Here's some help for you:**
 ```
@@ -150,17 +181,23 @@ Get some information about this bot.
 logger.info("Booting MyAnimeBot " + VERSION + "...")
 logger.debug("DEBUG log: OK")
 
+# The items found more than secondMax seconds after their publication are never announced,
+# the quiet users must be checked at least twice during this time (queue delay included)
+if pollMaxInterval > secondMax // 2:
+	pollMaxInterval = max(pollMinInterval, secondMax // 2)
+	logger.warning("pollMaxInterval must be at most half of secondMax (" + str(secondMax) + "s), it's reduced to " + str(pollMaxInterval) + "s")
+
+if pollMinInterval > secondMax // 2: logger.warning("pollMinInterval is more than half of secondMax (" + str(secondMax) + "s), some updates won't be announced")
+
 feedparser.PREFERRED_XML_PARSERS.remove("drv_libxml2")
 
 # Initialization of the database
 try:
-	# Main database connection
-	conn = mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName)
+	# Pool of connections used by all the tasks
+	db = database.AsyncDatabase("myanimebot", dbPoolSize, host=dbHost, user=dbUser, password=dbPassword, database=dbName)
 	
-	# We initialize the logs into the DB.
-	log_conn   = mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName)
-	log_cursor = log_conn.cursor()
-	logdb = LogDBHandler(log_conn, log_cursor)
+	# We initialize the logs into the DB, written in batches by their own thread and connection.
+	logdb = dblog.LogDBHandler(lambda: mariadb.connect(host=dbHost, user=dbUser, password=dbPassword, database=dbName), logDbBatchSize, logDbFlushInterval, logDbQueueSize)
 	logging.getLogger('').addHandler(logdb)
 	
 	logger.info("The database logger is running.")
@@ -168,20 +205,197 @@ except Exception as e:
 	logger.critical("Can't connect to the database: " + str(e))
 	quit()
 
+# Local copy of the thumbnails, disabled when no path is given
+thumbnailStore = None
+
+if thumbnailStorePath != "":
+	try:
+		thumbnailStore = thumbstore.ThumbnailStore(thumbnailStorePath, thumbnailStoreMaxSize * 1024 * 1024, thumbnailStoreMaxDimension)
+		
+		logger.info("Thumbnail store loaded: " + str(len(thumbnailStore.files)) + " images.")
+	except Exception as e:
+		logger.error("Can't load the thumbnail store, the thumbnails will be linked from MyAnimeList: " + str(e))
+
+# Titles shown in the bot's activity, the feed task adds the new medias even before the pool is loaded
+titlePool = titlepool.TitlePool()
+titlePoolLoaded = False
+titlePoolWeighted = 0
 
-# Initialization of the Discord client
-client = discord.Client()
+# Delay between two computations of the weights of the title pool, the old activity is forgotten
+TITLE_POOL_WEIGHT_INTERVAL = 3600
+
+# Number of times each media was added during the last titlePoolActivityDays days
+async def get_title_activity():
+	global titlePoolWeighted
+	
+	activity = dict(await db.fetchall("SELECT url, COUNT(0) FROM t_feeds WHERE published >= NOW() - INTERVAL %s DAY GROUP BY url", [titlePoolActivityDays]))
+	titlePoolWeighted = time.monotonic()
+	
+	return activity
+
+# Load all the medias into the title pool, weighted by how many times they were added lately
+async def load_title_pool():
+	global titlePoolLoaded
+	
+	activity = await get_title_activity()
+	
+	for data in await db.fetchall("SELECT guid, title FROM t_animes"):
+		titlePool.add(data[0], data[1], 1 + activity.get(data[0], 0))
+	
+	# The medias added by the feed task before the loading get their real weight too
+	titlePool.reweight(activity)
+	titlePoolLoaded = True
+	logger.info("Title pool loaded: " + str(len(titlePool)) + " medias.")
+
+# Results of the top command, by keyword ("" for the global top): keyword -> (time, result)
+topCache = {}
+
+# Maximum number of keywords kept in topCache
+TOP_CACHE_SIZE = 1000
+
+# Get the statistics of the top command, computed at most once every topCacheTTL seconds
+async def get_top(keyword):
+	key = keyword.lower()
+	cached = topCache.get(key)
+	
+	if cached is not None and time.monotonic() - cached[0] < topCacheTTL: return cached[1]
+	
+	if key == "":
+		totals = dict(await db.fetchall("SELECT name, total FROM t_stats_totals"))
+		result = (await db.fetchall("SELECT user, total FROM t_stats_users ORDER BY total DESC"), totals.get("feeds", 0), totals.get("animes", 0))
+	else: result = await db.callproc('sp_UsersPerKeyword', [keyword, '20'])
+	
+	# Forget the expired results, or everything if there are still too many
+	if len(topCache) >= TOP_CACHE_SIZE:
+		for old_key in [old_key for old_key, value in topCache.items() if time.monotonic() - value[0] >= topCacheTTL]: del topCache[old_key]
+		if len(topCache) >= TOP_CACHE_SIZE: topCache.clear()
+	
+	topCache[key] = (time.monotonic(), result)
+	return result
+
+# Shared HTTP session, created on first use inside the event loop
+httpclient = None
+
+# Get the HTTP session used for all the requests to MyAnimeList
+def get_http_session():
+	global httpclient
+	
+	if httpclient is None or httpclient.closed:
+		connector = aiohttp.TCPConnector(limit=httpMaxConnections, limit_per_host=httpMaxConnectionsPerHost, use_dns_cache=True, ttl_dns_cache=httpDnsCacheTTL)
+		httpclient = aiohttp.ClientSession(connector=connector, headers=HTTP_HEADERS)
+		
+	return httpclient
+
+async def close_http_session():
+	if httpclient is not None and not httpclient.closed: await httpclient.close()
+
+# Discord client that release the HTTP session when it closes
+class MyAnimeBotClient(discord.Client):
+	async def close(self):
+		await leave_workers()
+		await close_http_session()
+		
+		if thumbnailStore is not None: thumbnailStore.close()
+		await super().close()
+
+# Initialization of the Discord client, receiving only the events used by the bot:
+# the guilds and their channels, and the messages for the commands. No message is cached.
+if hasattr(discord, "Intents"):
+	intents = discord.Intents.none()
+	intents.guilds = True
+	intents.guild_messages = True
+	
+	# Privileged intent of the recent versions of Discord, to be enabled for the bot on the developer portal
+	if hasattr(intents, "message_content"): intents.message_content = True
+	
+	client = MyAnimeBotClient(intents=intents, max_messages=None)
+else: client = MyAnimeBotClient(guild_subscriptions=False, max_messages=None)
 
 task_feed       = None
 task_gameplayed = None
 task_thumbnail  = None
 
+# Global budget of requests sent to MyAnimeList
+malLimiter = ratelimit.RateLimiter(requestsPerSecond, max_backoff=malMaxBackoff)
+
+# Status codes of MyAnimeList waiting to be written into t_availability, and the last one recorded
+availabilityCodes = []
+lastAvailability = (None, 0)
+
+# Budget of the thumbnail checks, sent to the CDN of MyAnimeList
+thumbnailLimiter = ratelimit.RateLimiter(thumbnailRequestsPerSecond)
+
+# Number of thumbnails saved in the database at once
+THUMBNAIL_BATCH_SIZE = 100
+
+# Metrics of each stage of the checks, served to Prometheus on metricsPort
+POLL_SECONDS      = metrics.REGISTRY.histogram("myanimebot_poll_seconds", "Duration of the check of the feeds of a user")
+POLL_DELAY        = metrics.REGISTRY.histogram("myanimebot_poll_delay_seconds", "Delay between the time a user should be checked and the start of the check")
+POLL_QUEUE        = metrics.REGISTRY.gauge("myanimebot_poll_queue_users", "Users waiting for a worker")
+FEED_PARSE        = metrics.REGISTRY.histogram("myanimebot_feed_parse_seconds", "Duration of the parsing of a feed")
+FEED_ITEMS        = metrics.REGISTRY.counter("myanimebot_feed_items_total", "Feed items seen, new (recent and not in the index) and announced", ["stage"])
+HTTP_SECONDS      = metrics.REGISTRY.histogram("myanimebot_http_request_seconds", "Duration of the HTTP requests, by request", ["request"])
+HTTP_RESPONSES    = metrics.REGISTRY.counter("myanimebot_http_responses_total", "HTTP responses by site and status code (0 for a network error)", ["site", "code"])
+EVENT_LOOP_LAG    = metrics.REGISTRY.histogram("myanimebot_event_loop_lag_seconds", "Delay of a timer of the event loop", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+# Remember how MyAnimeList answered (0 for a network error). The same code is recorded
+# at most once every availabilityInterval seconds, a change of code is always recorded.
+def record_availability(code):
+	global lastAvailability
+	
+	if code == lastAvailability[0] and time.monotonic() - lastAvailability[1] < availabilityInterval: return
+	
+	lastAvailability = (code, time.monotonic())
+	availabilityCodes.append([datetime.now(timezone).strftime("%Y-%m-%d %H:%M:%S"), code])
+
+# Write the recorded status codes into t_availability
+async def flush_availability():
+	global availabilityCodes
+	
+	if len(availabilityCodes) == 0: return
+	
+	codes, availabilityCodes = availabilityCodes, []
+	
+	try:
+		await db.executemany("INSERT INTO t_availability (date, service, code) VALUES (%s, 'mal', %s)", codes)
+	except Exception as e:
+		logger.warning("Unable to save the availability of MyAnimeList: " + str(e))
+
+# Let the limiter know how MyAnimeList answered, all the requests are paused while it's throttling us or down
+def report_mal_status(status, headers=None):
+	failures = malLimiter.failures
+	delay = malLimiter.report(status, utils.getRetryAfter(headers))
+	
+	record_availability(status)
+	HTTP_RESPONSES.inc(site="mal", code=status)
+	
+	if delay > 0 and failures == 0: logger.warning("MyAnimeList answered with the code " + str(status) + ", the requests are paused for " + str(round(delay)) + "s")
+	elif delay > 0: logger.debug("MyAnimeList still unavailable (" + str(status) + "), the requests are paused for " + str(round(delay)) + "s")
+	elif failures > 0: logger.info("MyAnimeList is available again")
+
+# Get the thumbnail of a media from its page on MyAnimeList
+async def get_mal_thumbnail(url):
+	await malLimiter.acquire()
+	
+	try:
+		with HTTP_SECONDS.time(request="media_page"):
+			image = await utils.getThumbnailAsync(get_http_session(), url)
+	except aiohttp.ClientResponseError as e:
+		report_mal_status(e.status, e.headers)
+		raise
+	except (aiohttp.ClientError, asyncio.TimeoutError):
+		report_mal_status(0)
+		raise
+	
+	report_mal_status(200)
+	return image
+
 # Function used to make the embed message related to the animes status
 def build_embed(user, item, channel, pubDate, image):
 	try:	
 		embed = discord.Embed(colour=0xEED000, url=item.link, description="[" + utils.filter_name(item.title) + "](" + item.link + ")\n```" + item.description + "```", timestamp=pubDate.astimezone(pytz.timezone("utc")))
 		embed.set_thumbnail(url=image)
-		embed.set_author(name=user + "'s MyAnimeList", url="https://myanimelist.net/profile/" + user, icon_url=iconMAL)
+		embed.set_author(name=user + "'s MyAnimeList", url=malUrl + "/profile/" + user, icon_url=iconMAL)
 		embed.set_footer(text="MyAnimeBot", icon_url=iconBot)
 		
 		return embed
@@ -189,374 +403,785 @@ def build_embed(user, item, channel, pubDate, image):
 		logger.error("Error when generating the message: " + str(e))
 		return
 
-# Function used to send the embed
-async def send_embed_wrapper(asyncioloop, channelid, client, embed):
-	channel = client.get_channel(int(channelid))
+# Messages waiting to be sent, by channel, the feeds are checked meanwhile
+sendQueue = sendqueue.SendQueue(client, logger)
+
+# Download a thumbnail into the local store, if it's enabled and doesn't have it yet
+async def store_thumbnail(guid, image, replace=False):
+	if thumbnailStore is None or image is None or image == "": return
+	if thumbnailStore.contains(guid) and not replace: return
 	
 	try:
-		await channel.send(embed=embed)
-		logger.info("Message sent in channel: " + channelid)
+		await thumbnailStore.fetch(get_http_session(), guid, image)
 	except Exception as e:
-		logger.debug("Impossible to send a message on '" + channelid + "': " + str(e)) 
-		return
+		logger.warning("Unable to store the thumbnail of '" + guid + "': " + str(e))
+
+# HTTP validators (ETag, Last-Modified) of the feeds, by user and media
+feedValidators = {}
+
+# Publication date (aware, compared in UTC) of the newest item processed, by user and media.
+# The local dates can't be compared, they go back in time when the daylight saving time ends.
+feedMarks = {}
+
+# Load the HTTP validators and the newest items processed during the previous runs (or by another instance)
+async def load_feed_state(users=None):
+	if users is None: datas = await db.fetchall("SELECT user, media, etag, last_modified, last_published_utc FROM t_feed_state")
+	else: datas = await db.fetchall("SELECT user, media, etag, last_modified, last_published_utc FROM t_feed_state WHERE user IN (" + ", ".join(["%s"] * len(users)) + ")", users)
 	
-# Main function that check the RSS feeds from MyAnimeList
-async def background_check_feed(asyncioloop):
-	logger.info("Starting up background_check_feed")
+	for data in datas:
+		feedValidators[(data[0].lower(), data[1])] = (data[2], data[3])
+		if data[4] is not None: feedMarks[(data[0].lower(), data[1])] = pytz.utc.localize(data[4])
 	
-	# We configure the http header
-	http_headers = { "User-Agent": "MyAnimeBot Discord Bot v" + VERSION, }
+	logger.debug(str(len(feedValidators)) + " feed validators loaded")
+
+# Build the conditional headers of a feed request
+def get_conditional_headers(user, media):
+	headers = {}
+	validators = feedValidators.get((user.lower(), media))
 	
-	await client.wait_until_ready()
+	if validators is not None:
+		if validators[0]: headers["If-None-Match"] = validators[0]
+		if validators[1]: headers["If-Modified-Since"] = validators[1]
+		
+	return headers
+
+# Remember the validators sent back with a feed, so it is downloaded only when it changes
+async def save_feed_validators(user, media, http_headers):
+	validators = (http_headers.get("ETag"), http_headers.get("Last-Modified"))
 	
-	logger.debug("Discord client connected, unlocking background_check_feed...")
+	if validators == feedValidators.get((user.lower(), media), (None, None)): return
 	
-	while not client.is_closed():
-		try:
-			db_user = conn.cursor(buffered=True)
-			db_user.execute("SELECT mal_user, servers FROM t_users")
-			data_user = db_user.fetchone()
-		except Exception as e:
-			logger.critical("Database unavailable! (" + str(e) + ")")
-			quit()
+	feedValidators[(user.lower(), media)] = validators
+	
+	try:
+		await db.execute("INSERT INTO t_feed_state (user, media, etag, last_modified) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE etag = VALUES(etag), last_modified = VALUES(last_modified)", [user, media, validators[0], validators[1]])
+	except Exception as e:
+		logger.warning("Error while saving the feed validators of '" + user + "': " + str(e))
+
+# Remember the newest item processed in a feed, the items published before won't be checked again
+async def save_feed_mark(user, media, published):
+	mark = feedMarks.get((user.lower(), media))
+	if mark is not None and published <= mark: return
+	
+	feedMarks[(user.lower(), media)] = published
+	
+	try:
+		await db.execute("INSERT INTO t_feed_state (user, media, last_published_utc) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE last_published_utc = VALUES(last_published_utc)", [user, media, published.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S")])
+	except Exception as e:
+		logger.warning("Error while saving the newest item of the feed of '" + user + "': " + str(e))
+
+# Publication dates of the feed items, converted once into our timezone
+feedDates = malrss.DateParser(timezone)
+
+# Items already announced, published during the last secondMax seconds
+feedIndex = feedindex.FeedIndex()
+
+# Load the items recently announced into the index
+async def load_feed_index():
+	for data in await db.fetchall("SELECT user, published, title FROM t_feeds WHERE published >= NOW() - INTERVAL %s SECOND", [secondMax]):
+		if data[0] is not None and data[2] is not None: feedIndex.add(data[0], data[1].strftime("%Y-%m-%d %H:%M:%S"), data[2])
+	
+	logger.debug(str(len(feedIndex)) + " feed items loaded into the index")
 
-		while data_user is not None:
-			user=data_user[0]
-			stop_boucle = 0
-			feed_type = 1
+# Channels where the activity of each user is displayed, rebuilt when set to None
+userChannels = None
+userChannelsVersion = 0
+
+# Build the channels of all the users with a single query
+async def load_user_channels():
+	channels = {}
+	
+	for data in await db.fetchall("SELECT t_users.mal_user, t_servers.channel FROM t_users_servers JOIN t_users ON t_users.id = t_users_servers.user_id JOIN t_servers ON t_servers.server = t_users_servers.server WHERE t_servers.channel IS NOT NULL"):
+		channels.setdefault(data[0].lower(), []).append(data[1])
+		
+	return channels
+
+async def get_user_channels(user):
+	global userChannels
+	
+	channels = userChannels
+	
+	if channels is None:
+		version = userChannelsVersion
+		channels = await load_user_channels()
+		
+		# Only keep it if nothing changed during the loading
+		if version == userChannelsVersion: userChannels = channels
+		
+	return channels.get(user.lower(), [])
+
+# To be called after each change of t_users or t_servers
+def invalidate_user_channels():
+	global userChannels, userChannelsVersion
+	
+	userChannels = None
+	userChannelsVersion += 1
+
+# Check the manga and anime feeds of a single user, return True if something new was found
+async def check_user_feed(asyncioloop, data_user):
+	user=data_user[0]
+	active = False
+	
+	logger.debug("checking user: " + user)
+	
+	try:
+		for feed_type in (1, 0):
+			# We wait for our turn, all the workers share the same budget of requests
+			await malLimiter.acquire()
 			
-			logger.debug("checking user: " + user)
+			if feed_type == 1 :
+				url = malUrl + "/rss.php?type=rm&u=" + user
+				media = "manga"
+			else : 
+				url = malUrl + "/rss.php?type=rw&u=" + user
+				media = "anime"
+			
+			# Every response is measured, the 304 and the errors included
+			requestStart = time.perf_counter()
 			
 			try:
-				while stop_boucle == 0 :
-					try:
-						async with aiohttp.ClientSession() as httpclient:
-							if feed_type == 1 :
-								http_response = await httpclient.request("GET", "https://myanimelist.net/rss.php?type=rm&u=" + user, headers=http_headers)
-								media = "manga"
-							else : 
-								http_response = await httpclient.request("GET", "https://myanimelist.net/rss.php?type=rw&u=" + user, headers=http_headers)
-								media = "anime"
-					except Exception as e:
-						logger.error("Error while loading RSS (" + str(feed_type) + ") of '" + user + "': " + str(e))
-						break
-
-					http_data = await http_response.read()
-					feed_data = feedparser.parse(http_data)
+				async with get_http_session().get(url, headers=get_conditional_headers(user, media)) as http_response:
+					report_mal_status(http_response.status, http_response.headers)
+					
+					# Nothing changed since the last check, no need to parse the feed
+					if http_response.status == HTTPNotModified.status_code:
+						logger.debug("Feed (" + media + ") of '" + user + "' not modified")
+						continue
 					
-					for item in feed_data.entries:
-						pubDateRaw = datetime.strptime(item.published, '%a, %d %b %Y %H:%M:%S %z').astimezone(timezone)
-						DateTimezone = pubDateRaw.strftime("%z")[:3] + ':' + pubDateRaw.strftime("%z")[3:]
-						pubDate = pubDateRaw.strftime("%Y-%m-%d %H:%M:%S")
-						
-						cursor = conn.cursor(buffered=True)
-						cursor.execute("SELECT published, title, url FROM t_feeds WHERE published=%s AND title=%s AND user=%s", [pubDate, item.title, user])
-						data = cursor.fetchone()
-
-						if data is None:
-							var = datetime.now(timezone) - pubDateRaw
-							
-							logger.debug(" - " + item.title + ": " + str(var.total_seconds()))
-						
-							if var.total_seconds() < secondMax:
-								logger.info(user + ": Item '" + item.title + "' not seen, processing...")
-								
-								if item.description.startswith('-') :
-									if feed_type == 1 :	item.description = "Re-Reading " + item.description
-									else :				item.description = "Re-Watching " + item.description
-								
-								cursor.execute("SELECT thumbnail FROM t_animes WHERE guid=%s LIMIT 1", [item.guid])
-								data_img = cursor.fetchone()
-								
-								if data_img is None:
-									try:
-										image = utils.getThumbnail(item.link)
-										
-										logger.info("First time seeing this " + media + ", adding thumbnail into database: " + image)
-									except Exception as e:
-										logger.warning("Error while getting the thumbnail: " + str(e))
-										image = ""
-										
-									cursor.execute("INSERT INTO t_animes (guid, title, thumbnail, found, discoverer, media) VALUES (%s, %s, %s, NOW(), %s, %s)", [item.guid, item.title, image, user, media])
-									conn.commit()
-								else: image = data_img[0]
-
-								type = item.description.partition(" - ")[0]
-								
-								cursor.execute("INSERT INTO t_feeds (published, title, url, user, found, type) VALUES (%s, %s, %s, %s, NOW(), %s)", (pubDate, item.title, item.guid, user, type))
-								conn.commit()
-								
-								for server in data_user[1].split(","):
-									db_srv = conn.cursor(buffered=True)
-									db_srv.execute("SELECT channel FROM t_servers WHERE server = %s", [server])
-									data_channel = db_srv.fetchone()
-									
-									while data_channel is not None:
-										for channel in data_channel: await send_embed_wrapper(asyncioloop, channel, client, build_embed(user, item, channel, pubDateRaw, image))
-										
-										data_channel = db_srv.fetchone()
-					if feed_type == 1:
-						feed_type = 0
-						await asyncio.sleep(1)
-					else:
-						stop_boucle = 1
+					# Throttled, down or private profile, the feeds will be checked again later
+					if http_response.status >= 400:
+						logger.debug("Feed (" + media + ") of '" + user + "' unavailable: " + str(http_response.status))
+						break
 					
+					http_data = await http_response.read()
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				report_mal_status(0)
+				logger.debug("Error while loading RSS (" + str(feed_type) + ") of '" + user + "': " + str(e))
+				break
 			except Exception as e:
-				logger.error("Error when parsing RSS for '" + user + "': " + str(e))
+				logger.error("Error while loading RSS (" + str(feed_type) + ") of '" + user + "': " + str(e))
+				break
+			finally:
+				HTTP_SECONDS.observe(time.perf_counter() - requestStart, request="feed")
+
+			mark = feedMarks.get((user.lower(), media))
+			newest = None
+			new_items = []
 			
-			await asyncio.sleep(1)
+			with FEED_PARSE.time():
+				items = malrss.parse(http_data)
+			
+			for item in items:
+				pubDateRaw, pubDate = feedDates.parse(item.published)
+				FEED_ITEMS.inc(stage="seen")
+				
+				# The feed starts with the newest items, the next ones have already been processed
+				if mark is not None and pubDateRaw <= mark: break
+				if newest is None or pubDateRaw > newest: newest = pubDateRaw
+				
+				# Already announced
+				if feedIndex.contains(user, pubDate, item.title): continue
+				
+				var = datetime.now(timezone) - pubDateRaw
+				
+				logger.debug(" - " + item.title + ": " + str(var.total_seconds()))
+				
+				# Too old to be announced, and so are the next ones
+				if var.total_seconds() >= secondMax: break
+				
+				new_items.append((item, pubDateRaw, pubDate))
+			
+			if len(new_items) > 0:
+				FEED_ITEMS.inc(len(new_items), stage="new")
+				await announce_feed_items(asyncioloop, user, feed_type, media, new_items)
+				active = True
+			if newest is not None: await save_feed_mark(user, media, newest)
+			
+			# Saved once the items are stored, the feed is downloaded again if something failed
+			if http_response.status == 200: await save_feed_validators(user, media, http_response.headers)
+			
+	except Exception as e:
+		logger.error("Error when parsing RSS for '" + user + "': " + str(e))
+	
+	return active
+
+# Store the new items of a feed in a single transaction, then send them to the channels of the user
+async def announce_feed_items(asyncioloop, user, feed_type, media, new_items):
+	# Not in the index, they may still have been stored by someone else
+	oldest = min(new_item[2] for new_item in new_items)
+	
+	for data in await db.fetchall("SELECT published, title FROM t_feeds WHERE user=%s AND published >= %s", [user, oldest]):
+		if data[1] is not None: feedIndex.add(user, data[0].strftime("%Y-%m-%d %H:%M:%S"), data[1])
+	
+	new_items = [new_item for new_item in new_items if not feedIndex.contains(user, new_item[2], new_item[0].title)]
+	if len(new_items) == 0: return
+	
+	guids = list({ new_item[0].guid for new_item in new_items })
+	thumbnails = dict(await db.fetchall("SELECT guid, thumbnail FROM t_animes WHERE guid IN (" + ", ".join(["%s"] * len(guids)) + ")", guids))
+	new_medias = {}
+	feeds = []
+	
+	for item, pubDateRaw, pubDate in new_items:
+		logger.info(user + ": Item '" + item.title + "' not seen, processing...")
+		
+		if item.description.startswith('-') :
+			if feed_type == 1 :	item.description = "Re-Reading " + item.description
+			else :				item.description = "Re-Watching " + item.description
+		
+		if item.guid not in thumbnails:
+			try:
+				image = await get_mal_thumbnail(item.link)
+				
+				logger.info("First time seeing this " + media + ", adding thumbnail into database: " + image)
+			except Exception as e:
+				logger.warning("Error while getting the thumbnail: " + str(e))
+				image = ""
+			
+			thumbnails[item.guid] = image
+			new_medias[item.guid] = [item.guid, item.title, image, user, media]
+		
+		feeds.append([pubDate, item.title, item.guid, user, item.description.partition(" - ")[0]])
+	
+	inserted = await db.run(insert_feeds, user, feeds, list(new_medias.values()))
+	
+	# Everything is stored, the items stored meanwhile by another instance are announced by it
+	for item, pubDateRaw, pubDate in new_items:
+		feedIndex.add(user, pubDate, item.title)
+		if item.guid in new_medias: titlePool.add(item.guid, item.title)
+	
+	new_items = [new_item for new_item, stored in zip(new_items, inserted) if stored]
+	
+	for item, pubDateRaw, pubDate in new_items: titlePool.bump(item.guid)
+	
+	FEED_ITEMS.inc(len(new_items), stage="announced")
+	
+	for item, pubDateRaw, pubDate in new_items:
+		image = thumbnails[item.guid]
+		
+		# The stored copy is sent with the message, the link to MyAnimeList may be broken
+		await store_thumbnail(item.guid, image)
+		thumbnail = None if thumbnailStore is None else thumbnailStore.get(item.guid)
+		
+		# The message is queued for all the channels, each channel sending its own messages
+		for channel in await get_user_channels(user):
+			embed = build_embed(user, item, channel, pubDateRaw, image if thumbnail is None else "attachment://" + os.path.basename(thumbnail))
+			if embed is not None: sendQueue.put(channel, embed, thumbnail, image)
+
+# Store the new items of a feed and the new medias, with the statistics, in a single transaction.
+# The duplicates (stored meanwhile by another task or instance) are ignored, return for each
+# item whether it was inserted, only those must be announced.
+def insert_feeds(cursor, user, feeds, medias):
+	if len(medias) > 0:
+		cursor.execute("INSERT IGNORE INTO t_animes (guid, title, thumbnail, found, discoverer, media) VALUES " + ", ".join(["(%s, %s, %s, NOW(), %s, %s)"] * len(medias)), [value for media in medias for value in media])
+		
+		if cursor.rowcount > 0: cursor.execute("INSERT INTO t_stats_totals (name, total) VALUES ('animes', %s) ON DUPLICATE KEY UPDATE total = total + VALUES(total)", [cursor.rowcount])
+	
+	# One row at a time, to know which items were already there
+	inserted = []
+	titles = {}
+	
+	for feed in feeds:
+		cursor.execute("INSERT IGNORE INTO t_feeds (published, title, url, user, found, type) VALUES (%s, %s, %s, %s, NOW(), %s)", feed)
+		inserted.append(cursor.rowcount == 1)
+		
+		if cursor.rowcount == 1: titles[feed[1]] = titles.get(feed[1], 0) + 1
+	
+	total = sum(titles.values())
+	if total == 0: return inserted
+	
+	cursor.execute("INSERT INTO t_stats_totals (name, total) VALUES ('feeds', %s) ON DUPLICATE KEY UPDATE total = total + VALUES(total)", [total])
+	cursor.execute("INSERT INTO t_stats_users (user, total) VALUES (%s, %s) ON DUPLICATE KEY UPDATE total = total + VALUES(total)", [user, total])
+	cursor.execute("INSERT INTO t_stats_titles (title, user, total) VALUES " + ", ".join(["(%s, %s, %s)"] * len(titles)) + " ON DUPLICATE KEY UPDATE total = total + VALUES(total)", [value for title, count in titles.items() for value in (title, user, count)])
+	
+	return inserted
+
+# Users checked at their own pace, the active ones more often
+pollScheduler = scheduler.PollScheduler(pollMinInterval, pollMaxInterval)
+
+metrics.REGISTRY.gauge("myanimebot_users_scheduled", "Users checked by this instance", function=lambda: len(pollScheduler))
+metrics.REGISTRY.gauge("myanimebot_send_queue_embeds", "Embeds waiting to be sent to Discord", function=lambda: len(sendQueue))
+metrics.REGISTRY.gauge("myanimebot_feed_index_items", "Items in the index of the announced items", function=lambda: len(feedIndex))
+
+# Delay between two updates of the list of users
+USERS_RELOAD_INTERVAL = 60
+
+# Number of checks wanted between two updates of a list, on average
+POLLS_PER_UPDATE = 4
+
+# Update the users of the scheduler, with an interval based on their recent activity
+async def load_poll_users():
+	data_users = await db.fetchall("SELECT mal_user FROM t_users")
+	users = { data_user[0] for data_user in data_users }
+	
+	# Only the users of this instance
+	if sharding:
+		workers = await get_workers()
+		users = { user for user in users if shards.owner(user, workers) == workerId }
+	
+	for user in [user for user in pollScheduler.users if user not in users]: pollScheduler.remove(user)
+	
+	new_users = [user for user in users if user not in pollScheduler]
+	if len(new_users) == 0: return
+	
+	# The users taken from another instance may have been checked since our state was loaded
+	if sharding and len(pollScheduler) > 0: await load_feed_state(new_users)
+	
+	activity = dict(await db.fetchall("SELECT user, COUNT(0) FROM t_feeds WHERE published >= NOW() - INTERVAL %s DAY GROUP BY user", [pollActivityDays]))
+	
+	# The new users are checked right away, then as often as they update their lists
+	for user in new_users:
+		updates = activity.get(user, 0)
+		pollScheduler.add(user, pollMaxInterval if updates == 0 else 86400 * pollActivityDays / (updates * POLLS_PER_UPDATE))
+	
+	logger.debug(str(len(new_users)) + " users added to the scheduler, " + str(len(pollScheduler)) + " users scheduled")
+
+# Tell the other instances we're alive, and get the ones alive
+async def get_workers():
+	await db.execute("INSERT INTO t_workers (worker, heartbeat, gateway) VALUES (%s, NOW(), %s) ON DUPLICATE KEY UPDATE heartbeat = NOW(), gateway = VALUES(gateway)", [workerId, discordGateway])
+	
+	workers = [data[0] for data in await db.fetchall("SELECT worker FROM t_workers WHERE heartbeat >= NOW() - INTERVAL %s SECOND", [workerTimeout])]
+	
+	if workerId not in workers: workers.append(workerId)
+	return workers
+
+# Other instances alive and connected to the Discord gateway, only one of them must answer the commands
+async def get_gateway_workers():
+	return [data[0] for data in await db.fetchall("SELECT worker FROM t_workers WHERE gateway = 1 AND worker != %s AND heartbeat >= NOW() - INTERVAL %s SECOND", [workerId, workerTimeout])]
+
+# Let the other instances take our users right away
+async def leave_workers():
+	if not sharding: return
+	
+	try:
+		await db.execute("DELETE FROM t_workers WHERE worker = %s", [workerId])
+	except Exception as e:
+		logger.warning("Unable to remove this instance from the workers: " + str(e))
 
-			data_user = db_user.fetchone()
+# Worker polling the users waiting in the queue, until it is cancelled
+async def feed_worker(asyncioloop, queue):
+	while True:
+		user, due = await queue.get()
+		active = False
+		
+		POLL_DELAY.observe(time.monotonic() - due)
+		
+		try:
+			with POLL_SECONDS.time():
+				active = await check_user_feed(asyncioloop, [user])
+		finally:
+			pollScheduler.reschedule(user, active)
+			queue.task_done()
+
+# Serve the metrics in the text format of Prometheus, on http://metricsHost:metricsPort/metrics
+async def start_metrics_server():
+	if metricsPort == 0: return
+	
+	async def get_metrics(request):
+		return web.Response(text=metrics.REGISTRY.render(), content_type="text/plain")
+	
+	application = web.Application()
+	application.router.add_get("/metrics", get_metrics)
+	
+	runner = web.AppRunner(application)
+	await runner.setup()
+	await web.TCPSite(runner, metricsHost, metricsPort).start()
+	
+	logger.info("Metrics available on http://" + metricsHost + ":" + str(metricsPort) + "/metrics")
+
+# Measure how late the event loop wakes up a task, a blocking call delays all the tasks
+async def monitor_event_loop():
+	while not client.is_closed():
+		start = time.monotonic()
+		await asyncio.sleep(1)
+		
+		EVENT_LOOP_LAG.observe(max(0, time.monotonic() - start - 1))
+
+# Main function that check the RSS feeds from MyAnimeList
+async def background_check_feed():
+	logger.info("Starting up background_check_feed")
+	
+	# The loop of the client only exists once logged in with discord.py 2.x
+	asyncioloop = asyncio.get_running_loop()
+	
+	if discordGateway: await client.wait_until_ready()
+	
+	logger.debug("Discord client connected, unlocking background_check_feed...")
+	
+	try:
+		await load_feed_state()
+	except Exception as e:
+		logger.warning("Unable to load the feed validators, all the feeds will be downloaded: " + str(e))
+	
+	try:
+		await load_feed_index()
+	except Exception as e:
+		logger.warning("Unable to load the feed index, the items will be checked in the database: " + str(e))
+	
+	await start_metrics_server()
+	asyncioloop.create_task(monitor_event_loop())
+	
+	queue = asyncio.Queue()
+	nextReload = 0
+	
+	# The users are polled concurrently, the pace being given by malLimiter
+	workers = [asyncioloop.create_task(feed_worker(asyncioloop, queue)) for i in range(maxConcurrentUsers)]
+	
+	try:
+		while not client.is_closed():
+			if time.monotonic() >= nextReload:
+				try:
+					await load_poll_users()
+				except Exception as e:
+					logger.critical("Database unavailable! (" + str(e) + ")")
+					quit()
+				
+				# The commands are only received by the instance connected to the gateway,
+				# the other instances rebuild the channels of the users to see the changes
+				if sharding or not discordGateway: invalidate_user_channels()
+				
+				await flush_availability()
+				
+				# The items older than secondMax will never be announced again
+				feedIndex.prune((datetime.now(timezone) - timedelta(seconds=secondMax)).strftime("%Y-%m-%d %H:%M:%S"))
+				
+				nextReload = time.monotonic() + USERS_RELOAD_INTERVAL
+			
+			for user, due in pollScheduler.pop_due(): queue.put_nowait((user, due))
+			POLL_QUEUE.set(queue.qsize())
+			
+			await asyncio.sleep(1)
+	finally:
+		for worker in workers: worker.cancel()
 
 @client.event
 async def on_ready():
+	global task_feed, task_thumbnail, task_gameplayed
+	
 	logger.info("Logged in as " + client.user.name + " (" + str(client.user.id) + ")")
+	
+	if sharding:
+		try:
+			gateways = await get_gateway_workers()
+		except Exception as e:
+			logger.warning("Unable to check the other instances connected to the gateway: " + str(e))
+			gateways = []
+		
+		# Every command would be answered twice, and the thumbnails checked twice
+		if len(gateways) > 0:
+			logger.critical("The instance '" + gateways[0] + "' is already connected to the Discord gateway, set discordGateway = false on this one.")
+			await client.close()
+			return
 
 	logger.info("Starting all tasks...")
-
-	task_feed = client.loop.create_task(background_check_feed(client.loop))
-	task_thumbnail = client.loop.create_task(update_thumbnail_catalog(client.loop))
-	task_gameplayed = client.loop.create_task(change_gameplayed(client.loop))
+	
+	asyncioloop = asyncio.get_running_loop()
+	
+	task_feed = asyncioloop.create_task(background_check_feed())
+	task_thumbnail = asyncioloop.create_task(update_thumbnail_catalog(asyncioloop))
+	task_gameplayed = asyncioloop.create_task(change_gameplayed(asyncioloop))
 
 
 @client.event
 async def on_error(event, *args, **kwargs):
     logger.exception("Crap! An unknown Discord error occured...")
 
+# Add a user to a server, in a single transaction. Return False if it was already there.
+# The collation of mal_user is case insensitive, an existing user (added meanwhile by
+# another server included) is found by the unique index and his id is given back.
+def add_user_server(cursor, user, server):
+	cursor.execute("INSERT INTO t_users (mal_user) VALUES (%s) ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)", [user])
+	user_id = cursor.lastrowid
+	
+	cursor.execute("INSERT IGNORE INTO t_users_servers (user_id, server) VALUES (%s, %s)", [user_id, server])
+	
+	return cursor.rowcount == 1
+
+# Remove a user from a server, and from the database if it has no server left.
+# Return False if the user wasn't on this server.
+def delete_user_server(cursor, user, server):
+	cursor.execute("DELETE t_users_servers FROM t_users_servers JOIN t_users ON t_users.id = t_users_servers.user_id WHERE t_users.mal_user=%s AND t_users_servers.server=%s", [user, server])
+	
+	if cursor.rowcount == 0: return False
+	
+	cursor.execute("DELETE FROM t_users WHERE mal_user=%s AND NOT EXISTS (SELECT 1 FROM t_users_servers WHERE t_users_servers.user_id = t_users.id)", [user])
+	
+	return True
+
+# Configuration of the servers (channel, admin group) by server, loaded once then kept in sync with t_servers
+serverConfigs = None
+serverConfigsVersion = 0
+
+async def get_server_config(server):
+	global serverConfigs
+	
+	configs = serverConfigs
+	
+	if configs is None:
+		version = serverConfigsVersion
+		configs = { data[0]: (data[1], data[2]) for data in await db.fetchall("SELECT server, channel, admin_group FROM t_servers") }
+		
+		# Only keep it if nothing changed during the loading
+		if version == serverConfigsVersion: serverConfigs = configs
+		
+	return configs.get(server)
+
+# To be called after each change of t_servers, None when the server is removed
+def set_server_config(server, config):
+	global serverConfigsVersion
+	
+	serverConfigsVersion += 1
+	
+	if serverConfigs is None: return
+	if config is None: serverConfigs.pop(server, None)
+	else: serverConfigs[server] = config
+
+# Profiles already checked on MyAnimeList: user (lowercase) -> (expiration, exists)
+profileCache = {}
+
+# Checks of profiles on going, shared by all the commands asking for the same user
+profileChecks = {}
+
+# Maximum number of profiles kept in profileCache
+PROFILE_CACHE_SIZE = 10000
+
+# Return True or False if we know whether the profile exists, None if it must be checked
+def get_cached_profile(user):
+	cached = profileCache.get(user.lower())
+	
+	if cached is None or time.monotonic() >= cached[0]: return None
+	return cached[1]
+
+async def fetch_profile(user):
+	await malLimiter.acquire()
+	
+	try:
+		with HTTP_SECONDS.time(request="profile"):
+			async with get_http_session().get(malUrl + '/profile/' + user) as http_response:
+				report_mal_status(http_response.status, http_response.headers)
+				
+				if http_response.status != 404: http_response.raise_for_status()
+				exists = http_response.status != 404
+	except aiohttp.ClientResponseError:
+		raise
+	except (aiohttp.ClientError, asyncio.TimeoutError):
+		report_mal_status(0)
+		raise
+	
+	# Forget the expired results, or everything if there are still too many
+	if len(profileCache) >= PROFILE_CACHE_SIZE:
+		for old_user in [old_user for old_user, value in profileCache.items() if time.monotonic() >= value[0]]: del profileCache[old_user]
+		if len(profileCache) >= PROFILE_CACHE_SIZE: profileCache.clear()
+	
+	# A missing profile may be created soon, it's checked again sooner
+	profileCache[user.lower()] = (time.monotonic() + (profileCacheTTL if exists else profileNotFoundTTL), exists)
+	return exists
+
+# Check if a profile exists on MyAnimeList, the errors other than a 404 are raised and not cached
+async def check_profile(user):
+	exists = get_cached_profile(user)
+	if exists is not None: return exists
+	
+	key = user.lower()
+	check = profileChecks.get(key)
+	
+	if check is None:
+		check = asyncio.ensure_future(fetch_profile(user))
+		profileChecks[key] = check
+		check.add_done_callback(lambda future: profileChecks.pop(key, None))
+	
+	# A command cancelled doesn't cancel the check for the others
+	return await asyncio.shield(check)
+
+# Commands of the bot by name, each one being called with the message and its words
+COMMANDS = {}
+
+def command(name):
+	def register(function):
+		COMMANDS[name] = function
+		return function
+	
+	return register
+
 @client.event
 async def on_message(message):
 	if message.author == client.user: return
+	
+	# Most of the messages are not for us, they are ignored before being split
+	if message.content.startswith(prefix) and message.content[len(prefix):len(prefix) + 1] in ("", " "):
+		words = message.content.split(" ")
+		
+		if len(words) > 1:
+			handler = COMMANDS.get(words[1])
+			if handler is not None: await handler(message, words)
+		
+	# If mentioned
+	elif client.user in message.mentions:
+		await message.channel.send(":heart:")
 
-	words = message.content.split(" ")
-	author = str('{0.author.mention}'.format(message))
+@command("ping")
+async def command_ping(message, words):
+	await message.channel.send("pong")
 
-	# A user is trying to get help
-	if words[0] == prefix:
-		if len(words) > 1:
-			if words[1] == "ping": await message.channel.send("pong")
+@command("here")
+async def command_here(message, words):
+	if not message.author.guild_permissions.administrator:
+		await message.channel.send("Only server's admins can use this command!")
+		return
+	
+	server = str(message.guild.id)
+	channel = str(message.channel.id)
+	data = await get_server_config(server)
+	
+	if data is None:
+		await db.execute("INSERT INTO t_servers (server, channel) VALUES (%s,%s)", [server, channel])
+		set_server_config(server, (channel, None))
+		invalidate_user_channels()
+		
+		await message.channel.send("Channel **" + str(message.channel) + "** configured for **" + str(message.guild) + "**.")
+	elif data[0] == channel: await message.channel.send("Channel **" + str(message.channel) + "** already in use for this server.")
+	else:
+		await db.execute("UPDATE t_servers SET channel = %s WHERE server = %s", [channel, server])
+		set_server_config(server, (channel, data[1]))
+		invalidate_user_channels()
+		
+		await message.channel.send("Channel updated to: **" + str(message.channel) + "**.")
+
+@command("add")
+async def command_add(message, words):
+	if len(words) < 3:
+		await message.channel.send("You have to specify a **MyAnimeList** username!")
+		return
+	if len(words) > 3:
+		await message.channel.send("Too many arguments! You have to specify only one username.")
+		return
+	
+	user = words[2]
+	
+	if len(user) >= 15:
+		await message.channel.send("Username too long!")
+		return
+	
+	# No need to wait for the end of an outage to answer, unless the profile was already checked
+	if malLimiter.paused() and get_cached_profile(user) is None:
+		await message.channel.send("MyAnimeList seems to be down at the moment, try again later!")
+		return
+	
+	try:
+		if not await check_profile(user): await message.channel.send("User **" + user + "** doesn't exist on MyAnimeList!")
+		elif await db.run(add_user_server, user, str(message.guild.id)):
+			invalidate_user_channels()
 			
-			elif words[1] == "here":
-				if message.author.guild_permissions.administrator:
-					cursor = conn.cursor(buffered=True)
-					cursor.execute("SELECT server, channel FROM t_servers WHERE server=%s", [str(message.guild.id)])
-					data = cursor.fetchone()
-					
-					if data is None:
-						cursor.execute("INSERT INTO t_servers (server, channel) VALUES (%s,%s)", [str(message.guild.id), str(message.channel.id)])
-						conn.commit()
-						
-						await message.channel.send("Channel **" + str(message.channel) + "** configured for **" + str(message.guild) + "**.")
-					else:
-						if(data[1] == str(message.channel.id)): await message.channel.send("Channel **" + str(message.channel) + "** already in use for this server.")
-						else:
-							cursor.execute("UPDATE t_servers SET channel = %s WHERE server = %s", [str(message.channel.id), str(message.guild.id)])
-							conn.commit()
-							
-							await message.channel.send("Channel updated to: **" + str(message.channel) + "**.")
-							
-					cursor.close()
-				else: await message.channel.send("Only server's admins can use this command!")
-				
-			elif words[1] == "add":
-				if len(words) > 2:
-					if (len(words) == 3):
-						user = words[2]
-						
-						if(len(user) < 15):
-							try:
-								urllib.request.urlopen('https://myanimelist.net/profile/' + user)
-								
-								cursor = conn.cursor(buffered=True)
-								cursor.execute("SELECT servers FROM t_users WHERE LOWER(mal_user)=%s", [user.lower()])
-								data = cursor.fetchone()
-
-								if data is None:
-									cursor.execute("INSERT INTO t_users (mal_user, servers) VALUES (%s, %s)", [user, str(message.guild.id)])
-									conn.commit()
-									
-									await message.channel.send("**" + user + "** added to the database for the server **" + str(message.guild) + "**.")
-								else:
-									var = 0
-									
-									for server in data[0].split(","):
-										if (server == str(message.guild.id)): var = 1
-									
-									if (var == 1):
-										await message.channel.send("User **" + user + "** already in our database for this server!")
-									else:
-										cursor.execute("UPDATE t_users SET servers = %s WHERE LOWER(mal_user) = %s", [data[0] + "," + str(message.guild.id), user.lower()])
-										conn.commit()
-										
-										await message.channel.send("**" + user + "** added to the database for the server **" + str(message.guild) + "**.")
-										
-								cursor.close()
-							except urllib.error.HTTPError as e:
-								if (e.code == 404): await message.channel.send("User **" + user + "** doesn't exist on MyAnimeList!")
-								else:
-									await message.channel.send("An error occured when we checked this username on MyAnimeList, maybe the website is down?")
-									logger.warning("HTTP Code " + str(e.code) + " while checking to add for the new user '" + user + "'")
-							except Exception as e:
-								await message.channel.send("An unknown error occured while addind this user, the error has been logged.")
-								logger.warning("Error while adding user '" + user + "' on server '" + message.guild + "': " + str(e))
-						else: await message.channel.send("Username too long!")
-					else: await message.channel.send("Too many arguments! You have to specify only one username.")
-				else: await message.channel.send("You have to specify a **MyAnimeList** username!")
-				
-			elif words[1] == "delete":
-				if len(words) > 2:
-					if (len(words) == 3):
-						user = words[2]
-						
-						cursor = conn.cursor(buffered=True)
-						cursor.execute("SELECT servers FROM t_users WHERE LOWER(mal_user)=%s", [user.lower()])
-						data = cursor.fetchone()
-						
-						if data is not None:
-							srv_string = ""
-							present = 0
-							
-							for server in data[0].split(","):
-								if server != str(message.guild.id):
-									if srv_string == "": srv_string = server
-									else: srv_string += "," + server
-								else: present = 1
-							
-							if present == 1:
-								if srv_string == "": cursor.execute("DELETE FROM t_users WHERE LOWER(mal_user) = %s", [user.lower()])
-								else: cursor.execute("UPDATE t_users SET servers = %s WHERE LOWER(mal_user) = %s", [srv_string, user.lower()])
-								conn.commit()
-								
-								await message.channel.send("**" + user + "** deleted from the database for this server.")
-							else: await message.channel.send("The user **" + user + "** is not in our database for this server!")
-						else: await message.channel.send("The user **" + user + "** is not in our database for this server!")
+			await message.channel.send("**" + user + "** added to the database for the server **" + str(message.guild) + "**.")
+		else: await message.channel.send("User **" + user + "** already in our database for this server!")
+	except aiohttp.ClientResponseError as e:
+		await message.channel.send("An error occured when we checked this username on MyAnimeList, maybe the website is down?")
+		logger.warning("HTTP Code " + str(e.status) + " while checking to add for the new user '" + user + "'")
+	except Exception as e:
+		await message.channel.send("An unknown error occured while addind this user, the error has been logged.")
+		logger.warning("Error while adding user '" + user + "' on server '" + str(message.guild) + "': " + str(e))
+
+@command("delete")
+async def command_delete(message, words):
+	if len(words) < 3:
+		await message.channel.send("You have to specify a **MyAnimeList** username!")
+		return
+	if len(words) > 3:
+		await message.channel.send("Too many arguments! You have to specify only one username.")
+		return
+	
+	user = words[2]
+	
+	if await db.run(delete_user_server, user, str(message.guild.id)):
+		invalidate_user_channels()
+		
+		await message.channel.send("**" + user + "** deleted from the database for this server.")
+	else: await message.channel.send("The user **" + user + "** is not in our database for this server!")
+
+@command("stop")
+async def command_stop(message, words):
+	if not message.author.guild_permissions.administrator:
+		await message.channel.send("Only server's admins can use this command!")
+		return
+	if len(words) > 2:
+		await message.channel.send("Too many arguments! Only type *stop* if you want to stop this bot on **" + str(message.guild) + "**")
+		return
+	
+	server = str(message.guild.id)
+	
+	if await get_server_config(server) is None: await message.channel.send("The server **" + str(message.guild) + "** is not in our database.")
+	else:
+		await db.execute("DELETE FROM t_servers WHERE server = %s", [server])
+		set_server_config(server, None)
+		invalidate_user_channels()
+		
+		await message.channel.send("Server **" + str(message.guild) + "** deleted from our database.")
+
+@command("info")
+async def command_info(message, words):
+	data_channel = await get_server_config(str(message.guild.id))
+	
+	if data_channel is None: await message.channel.send("The server **" + str(message.guild) + "** is not in our database.")
+	elif data_channel[0] is None: await message.channel.send("No channel assigned for this bot in this server.")
+	else:
+		user = ", ".join([data[0] for data in await db.fetchall("SELECT t_users.mal_user FROM t_users_servers JOIN t_users ON t_users.id = t_users_servers.user_id WHERE t_users_servers.server = %s ORDER BY t_users.mal_user", [str(message.guild.id)])])
+		
+		if (user == ""): await message.channel.send("No user in this server.")
+		else: await message.channel.send("Here's the user(s) in the **" + str(message.guild) + "**'s server:\n```" + user + "```\nAssigned channel: **" + str(client.get_channel(int(data_channel[0]))) + "**")
+
+@command("about")
+async def command_about(message, words):
+	await message.channel.send(embed=discord.Embed(colour=0x777777, title="MyAnimeBot version " + VERSION + " by Penta", description="This bot check the MyAnimeList's RSS for each user specified, and send a message if there is something new.\nMore help with the **!malbot help** command.\n\nAdd me on steam: http://steamcommunity.com/id/Penta_Pingouin").set_thumbnail(url="https://cdn.discordapp.com/avatars/415474467033317376/2d847944aab2104923c18863a41647da.jpg?size=64"))
+
+@command("help")
+async def command_help(message, words):
+	await message.channel.send(HELP)
+
+@command("top")
+async def command_top(message, words):
+	if len(words) == 2:
+		try:
+			datas, totalFeeds, totalAnimes = await get_top("")
 			
-						cursor.close()
-					else: await message.channel.send("Too many arguments! You have to specify only one username.")
-				else: await message.channel.send("You have to specify a **MyAnimeList** username!")
+			if len(datas) == 0: await message.channel.send("It seems that there is no statistics... (what happened?!)")
+			else:
+				topText = "**__Here is the global statistics of this bot:__**\n\n"
 				
-			elif words[1] == "stop":
-				if message.author.guild_permissions.administrator:
-					if (len(words) == 2):
-						cursor = conn.cursor(buffered=True)
-						cursor.execute("SELECT server FROM t_servers WHERE server=%s", [str(message.guild.id)])
-						data = cursor.fetchone()
+				for data in datas:
+					topText += " - " + str(data[0]) + ": " + str(data[1]) + "\n"
 					
-						if data is None: await client.send_message(message.channel, "The server **" + str(message.guild) + "** is not in our database.")
-						else:
-							cursor.execute("DELETE FROM t_servers WHERE server = %s", [message.guild.id])
-							conn.commit()
-							await message.channel.send("Server **" + str(message.guild) + "** deleted from our database.")
-						
-						cursor.close()
-					else: await message.channel.send("Too many arguments! Only type *stop* if you want to stop this bot on **" + message.guild + "**")
-				else: await message.channel.send("Only server's admins can use this command!")
+				topText += "\n***Total user entry***: " + str(totalFeeds)
+				topText += "\n***Total unique manga/anime***: " + str(totalAnimes)
 				
-			elif words[1] == "info":
-				cursor = conn.cursor(buffered=True)
-				cursor.execute("SELECT server FROM t_servers WHERE server=%s", [str(message.guild.id)])
-				data = cursor.fetchone()
-				
-				if data is None: await message.channel.send("The server **" + str(message.guild) + "** is not in our database.")
-				else:
-					user = ""
-					cursor = conn.cursor(buffered=True)
-					cursor.execute("SELECT mal_user, servers FROM t_users")
-					data = cursor.fetchone()
-					
-					cursor_channel = conn.cursor(buffered=True)
-					cursor_channel.execute("SELECT channel FROM t_servers WHERE server=%s", [str(message.guild.id)])
-					data_channel = cursor_channel.fetchone()
-					
-					if data_channel is None: await message.channel.send("No channel assigned for this bot in this server.")
-					else:
-						while data is not None:
-							if (str(message.guild.id) in data[1].split(",")):
-								if (user == ""): user = data[0]
-								else: user += ", " + data[0]
-						
-							data = cursor.fetchone()
-						
-						if (user == ""): await message.channel.send("No user in this server.")
-						else: await message.channel.send("Here's the user(s) in the **" + str(message.guild) + "**'s server:\n```" + user + "```\nAssigned channel: **" + str(client.get_channel(int(data_channel[0]))) + "**")
-
-					cursor.close()
-					cursor_channel.close()
-			elif words[1] == "about": await message.channel.send(embed=discord.Embed(colour=0x777777, title="MyAnimeBot version " + VERSION + " by Penta", description="This bot check the MyAnimeList's RSS for each user specified, and send a message if there is something new.\nMore help with the **!malbot help** command.\n\nAdd me on steam: http://steamcommunity.com/id/Penta_Pingouin").set_thumbnail(url="https://cdn.discordapp.com/avatars/415474467033317376/2d847944aab2104923c18863a41647da.jpg?size=64"))
-			
-			elif words[1] == "help": await message.channel.send(HELP)
+				await message.channel.send(topText)
+		except Exception as e:
+			logger.warning("An error occured while displaying the global top: " + str(e))
+			await message.channel.send("Unable to reply to your request at the moment...")
+	else:
+		keyword = str(' '.join(words[2:]))
+		logger.info("Displaying the global top for the keyword: " + keyword)
+		
+		try:
+			datas = await get_top(keyword)
 			
-			elif words[1] == "top":
-				if len(words) == 2:
-					try:
-						cursor = conn.cursor(buffered=True)
-						cursor.execute("SELECT * FROM v_Top")
-						data = cursor.fetchone()
-						
-						if data is None: await message.channel.send("It seems that there is no statistics... (what happened?!)")
-						else:
-							topText = "**__Here is the global statistics of this bot:__**\n\n"
-							
-							while data is not None:
-								topText += " - " + str(data[0]) + ": " + str(data[1]) + "\n"
-									
-								data = cursor.fetchone()
-								
-							cursor = conn.cursor(buffered=True)
-							cursor.execute("SELECT * FROM v_TotalFeeds")
-							data = cursor.fetchone()
-							
-							topText += "\n***Total user entry***: " + str(data[0])
-							
-							cursor = conn.cursor(buffered=True)
-							cursor.execute("SELECT * FROM v_TotalAnimes")
-							data = cursor.fetchone()
-							
-							topText += "\n***Total unique manga/anime***: " + str(data[0])
-							
-							await message.channel.send(topText)
-						
-						cursor.close()
-					except Exception as e:
-						logger.warning("An error occured while displaying the global top: " + str(e))
-						await message.channel.send("Unable to reply to your request at the moment...")
-				elif len(words) > 2:
-					keyword = str(' '.join(words[2:]))
-					logger.info("Displaying the global top for the keyword: " + keyword)
+			if len(datas) == 0: await message.channel.send("It seems that there is no statistics for the keyword **" + keyword + "**.")
+			else:
+				topKeyText = "**__Here is the statistics for the keyword " + keyword + ":__**\n\n"
+				
+				for data in datas:
+					topKeyText += " - " + str(data[0]) + ": " + str(data[1]) + "\n"
 					
-					try:
-						cursor = conn.cursor(buffered=True)
-						cursor.callproc('sp_UsersPerKeyword', [str(keyword), '20'])
-						for result in cursor.stored_results():
-							data = result.fetchone()
-							
-							if data is None: await message.channel.send("It seems that there is no statistics for the keyword **" + keyword + "**.")
-							else:
-								topKeyText = "**__Here is the statistics for the keyword " + keyword + ":__**\n\n"
-								
-								while data is not None:
-									topKeyText += " - " + str(data[0]) + ": " + str(data[1]) + "\n"
-										
-									data = result.fetchone()
-									
-								await message.channel.send(topKeyText)
-							
-						cursor.close()
-					except Exception as e:
-						logger.warning("An error occured while displaying the global top for keyword '" + keyword + "': " + str(e))
-						await message.channel.send("Unable to reply to your request at the moment...")
-			
-			elif words[1] == "group":
-				if len(words) > 2:
-					if message.author.guild_permissions.administrator:
-						group = words[2]
-						await message.channel.send("admin OK")
-					else: await message.channel.send("Only server's admins can use this command!")
-				else:
-					await message.channel.send("You have to specify a group!")
-		
-	# If mentioned
-	elif client.user in message.mentions:
-		await message.channel.send(":heart:")
+				await message.channel.send(topKeyText)
+		except Exception as e:
+			logger.warning("An error occured while displaying the global top for keyword '" + keyword + "': " + str(e))
+			await message.channel.send("Unable to reply to your request at the moment...")
+
+@command("group")
+async def command_group(message, words):
+	if len(words) < 3: await message.channel.send("You have to specify a group!")
+	elif message.author.guild_permissions.administrator:
+		group = words[2]
+		await message.channel.send("admin OK")
+	else: await message.channel.send("Only server's admins can use this command!")
 
 # Get a random anime name and change the bot's activity
 async def change_gameplayed(asyncioloop):
@@ -566,76 +1191,145 @@ async def change_gameplayed(asyncioloop):
 	await asyncio.sleep(1)
 
 	while not client.is_closed():
-		# Get a random anime name from the users' list
-		cursor = conn.cursor(buffered=True)
-		cursor.execute("SELECT title FROM t_animes ORDER BY RAND() LIMIT 1")
-		data = cursor.fetchone()
-		anime = utils.truncate_end_show(data[0])
-		
+		# Get a random anime name from the users' list, loaded once then updated by the feed task
 		# Try to change the bot's activity
 		try:
-			if data is not None: await client.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=anime))
+			if not titlePoolLoaded: await load_title_pool()
+			elif time.monotonic() - titlePoolWeighted >= TITLE_POOL_WEIGHT_INTERVAL: titlePool.reweight(await get_title_activity())
+			
+			title = titlePool.sample()
+			
+			if title is not None: await client.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=title))
 		except Exception as e:
 			logger.warning("An error occured while changing the displayed anime title: " + str(e))
 			
-		cursor.close()
 		# Do it every minute
 		await asyncio.sleep(60)
 
-async def update_thumbnail_catalog(asyncioloop):
-	logger.info("Starting up update_thumbnail_catalog")
+# Check if a thumbnail can still be downloaded.
+# Return True or False, or None when it can't be known for now (network error, throttling...)
+async def is_thumbnail_alive(url, checked):
+	if url is None or url == "": return False
 	
-	while not client.is_closed():
-		await asyncio.sleep(43200)
+	await thumbnailLimiter.acquire()
+	
+	async with get_http_session().head(url, allow_redirects=True) as http_response:
+		status = http_response.status
+	
+	# HEAD not supported, the image is only downloaded if it changed since the last check
+	if status in (405, 501):
+		headers = {}
+		if checked is not None: headers["If-Modified-Since"] = email.utils.format_datetime(timezone.localize(checked).astimezone(pytz.utc), usegmt=True)
 		
-		logger.info("Automatic check of the thumbnail database on going...")
-		reload = 0
+		await thumbnailLimiter.acquire()
 		
-		cursor = conn.cursor(buffered=True)
-		cursor.execute("SELECT guid, title, thumbnail FROM t_animes")
-		data = cursor.fetchone()
+		async with get_http_session().get(url, headers=headers) as http_response:
+			status = http_response.status
+	
+	HTTP_RESPONSES.inc(site="cdn", code=status)
+	
+	if status < 400: return True
+	if status < 500 and status != 429: return False
+	return None
 
-		while data is not None:
-			try:
-				if (data[2] != "") : urllib.request.urlopen(data[2])
-				else: reload = 1
-			except urllib.error.HTTPError as e:
-				logger.warning("HTTP Error while getting the current thumbnail of '" + str(data[1]) + "': " + str(e))
-				reload = 1
-			except Exception as e:
-				logger.debug("Error while getting the current thumbnail of '" + str(data[1]) + "': " + str(e))
+# Check a thumbnail, and get a new one from MyAnimeList if it's broken
+async def check_thumbnail(data, semaphore, checked, updated):
+	async with semaphore:
+		# Already stored, a broken link doesn't matter anymore
+		if thumbnailStore is not None and thumbnailStore.contains(data[0]):
+			checked.append([data[0]])
+			return
+		
+		try:
+			alive = await is_thumbnail_alive(data[2], data[3])
+		except Exception as e:
+			logger.debug("Error while getting the current thumbnail of '" + str(data[1]) + "': " + str(e))
+			return
+		
+		if alive is None: return
+		if alive:
+			await store_thumbnail(data[0], data[2])
+			checked.append([data[0]])
+			return
+		
+		logger.warning("The current thumbnail of '" + str(data[1]) + "' is broken: " + str(data[2]))
+		
+		try:
+			image = await get_mal_thumbnail(data[0])
 			
-			if (reload == 1) :
-				try:
-					image = utils.getThumbnail(data[0])
-						
-					cursor.execute("UPDATE t_animes SET thumbnail = %s WHERE guid = %s", [image, data[0]])
-					conn.commit()
-						
-					logger.info("Updated thumbnail found for \"" + str(data[1]) + "\": %s", image)
-				except Exception as e:
-					logger.warning("Error while downloading updated thumbnail for '" + str(data[1]) + "': " + str(e))
+			updated.append([image, data[0]])
+			await store_thumbnail(data[0], image, True)
+			
+			logger.info("Updated thumbnail found for \"" + str(data[1]) + "\": %s", image)
+		except Exception as e:
+			logger.warning("Error while downloading updated thumbnail for '" + str(data[1]) + "': " + str(e))
 
-			await asyncio.sleep(3)
-			data = cursor.fetchone()
+# Check the thumbnails not checked since thumbnailMaxAge seconds, return the number of thumbnails verified and updated
+async def check_thumbnail_catalog():
+	datas = await db.fetchall("SELECT guid, title, thumbnail, thumbnail_checked FROM t_animes WHERE thumbnail_checked IS NULL OR thumbnail_checked < NOW() - INTERVAL %s SECOND", [thumbnailMaxAge])
+	
+	semaphore = asyncio.Semaphore(thumbnailConcurrency)
+	count = 0
+	
+	for i in range(0, len(datas), THUMBNAIL_BATCH_SIZE):
+		checked = []
+		updated = []
+		
+		await asyncio.gather(*[check_thumbnail(data, semaphore, checked, updated) for data in datas[i:i + THUMBNAIL_BATCH_SIZE]])
+		
+		try:
+			if len(checked) > 0: await db.executemany("UPDATE t_animes SET thumbnail_checked = NOW() WHERE guid = %s", checked)
+			if len(updated) > 0: await db.executemany("UPDATE t_animes SET thumbnail = %s, thumbnail_checked = NOW() WHERE guid = %s", updated)
+		except Exception as e:
+			logger.error("Unable to save the checked thumbnails: " + str(e))
+		
+		count += len(updated)
+	
+	return len(datas), count
 
-		cursor.close()
+async def update_thumbnail_catalog(asyncioloop):
+	logger.info("Starting up update_thumbnail_catalog")
+	
+	while not client.is_closed():
+		await asyncio.sleep(thumbnailCheckInterval)
+		
+		logger.info("Automatic check of the thumbnail database on going...")
+		
+		try:
+			verified, count = await check_thumbnail_catalog()
+		except Exception as e:
+			logger.error("Unable to get the thumbnail catalog: " + str(e))
+			continue
 
-		logger.info("Thumbnail database checked.")
+		logger.info("Thumbnail database checked: " + str(verified) + " verified, " + str(count) + " updated.")
+	
+# Instance checking its share of the feeds without connecting to the Discord gateway,
+# the messages are sent with the REST API
+async def run_without_gateway():
+	await client.login(token)
+	
+	logger.info("Logged in without the Discord gateway, only the feeds will be checked")
 	
+	try:
+		await background_check_feed()
+	finally:
+		await client.close()
+
 # Starting main function	
 if __name__ == "__main__":
     try:
-        client.run(token)
+        if discordGateway: client.run(token)
+        # discord.py 2.x creates its loop at login, the older versions with the client
+        elif hasattr(discord.Client, "setup_hook"): asyncio.run(run_without_gateway())
+        else: client.loop.run_until_complete(run_without_gateway())
     except:
         logging.info("Closing all tasks...")
-        task_feed.cancel()
-        task_thumbnail.cancel()
-        task_gameplayed.cancel()
+        
+        for task in (task_feed, task_thumbnail, task_gameplayed):
+            if task is not None: task.cancel()
 
     logger.critical("Script halted.")
 
 	# We close all the ressources
-    conn.close()
-    log_cursor.close()
-    log_conn.close()
+    db.close()
+    logdb.close()